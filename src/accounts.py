@@ -0,0 +1,72 @@
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Optional
+
+from qvantum_api import QvantumApi
+from qvantum_classes import MetricsResponse, Pump, QvantumBaseModel
+
+log = logging.getLogger(__name__)
+
+
+class Account:
+    def __init__(self, name: str, api: QvantumApi):
+        self.name = name
+        self.api = api
+        # Empty until the pumps of the account have been listed
+        self.devices: list[Pump] = []
+
+
+class Accounts:
+    """
+    The Qvantum accounts served by the bridge, and which account each pump belongs to.
+
+    Every account has its own tokens and token refresh, while the http connection pool
+    is shared. Calls for a pump are sent with the api of the account that owns it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.accounts: list[Account] = []
+        self.pumps: dict[str, Account] = {}
+
+    def add(self, account: Account):
+        with self.lock:
+            self.accounts.append(account)
+
+    def set_devices(self, account: Account, devices: list[Pump]):
+        with self.lock:
+            account.devices = devices
+            for pump in devices:
+                other = self.pumps.get(pump.id)
+                if other is not None and other is not account:
+                    log.warning(f"Pump {pump.id} is in both account {other.name} and {account.name}. "
+                                f"Using {account.name}.")
+                self.pumps[pump.id] = account
+
+    def get_devices(self) -> list[Pump]:
+        with self.lock:
+            return [pump for account in self.accounts for pump in account.devices]
+
+    def get_api(self, pump_id: str) -> Optional[QvantumApi]:
+        with self.lock:
+            account = self.pumps.get(pump_id)
+        if account is None:
+            log.warning(f"Pump {pump_id} is not in any of the accounts")
+            return None
+        return account.api
+
+    # The pump calls made outside of the poll loop, by the command queue and the backfill
+
+    def set_pump_settings(self, device_id: str, settings: dict[str, Any]) -> QvantumBaseModel:
+        api = self.get_api(device_id)
+        if api is None:
+            return None
+        return api.set_pump_settings(device_id, settings)
+
+    def get_pump_metric(self, device_id: str, metrics: list[str], start: Optional[datetime] = None,
+                        end: Optional[datetime] = None, resolution: str = "hourly") -> MetricsResponse:
+        api = self.get_api(device_id)
+        if api is None:
+            return None
+        return api.get_pump_metric(device_id, metrics, start=start, end=end, resolution=resolution)
@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Optional
+from zoneinfo import ZoneInfo
+
+from config import BackfillConfig
+from accounts import Accounts
+from files import write_file_atomic
+from qvantum_api import API_TIMEZONE
+from qvantum_classes import MetricsResponse
+
+log = logging.getLogger(__name__)
+
+
+class Backfill:
+    """
+    Pulls metric timelines for the pumps in chunks, from the last completed chunk up to now.
+
+    The end of the last completed chunk of every pump is stored in a checkpoint file, so
+    a backfill that was interrupted (or the downtime of the bridge) is resumed where it
+    stopped. Pumps are backfilled in parallel, within the shared request budget where
+    backfill goes last. Each chunk is handed to the publish callback.
+    """
+
+    def __init__(self, config: BackfillConfig, api: Accounts,
+                 publish: Callable[[str, str, MetricsResponse], None]):
+        self.config = config
+        self.api = api
+        self.publish = publish
+        self.lock = threading.Lock()
+        self.checkpoints: dict[str, str] = {}
+        self.wakeup = threading.Event()
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.config.checkpoint_path):
+            return
+        try:
+            with open(self.config.checkpoint_path, "r") as f:
+                self.checkpoints = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning(
+                f"Could not read backfill checkpoints {self.config.checkpoint_path}: {e!r}")
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.checkpoints)
+        try:
+            write_file_atomic(self.config.checkpoint_path, data)
+        except OSError as e:
+            log.warning(
+                f"Could not write backfill checkpoints {self.config.checkpoint_path}: {e!r}")
+
+    def get_checkpoint_key(self, pump_id: str) -> str:
+        return f"{pump_id}/{self.config.resolution}"
+
+    def get_checkpoint(self, pump_id: str) -> Optional[datetime]:
+        with self.lock:
+            value = self.checkpoints.get(self.get_checkpoint_key(pump_id))
+        return datetime.fromisoformat(value) if value is not None else None
+
+    def set_checkpoint(self, pump_id: str, end: datetime):
+        with self.lock:
+            self.checkpoints[self.get_checkpoint_key(pump_id)] = end.isoformat()
+        self.save()
+
+    def get_resolution_step(self) -> timedelta:
+        return timedelta(days=1) if self.config.resolution == "daily" else timedelta(hours=1)
+
+    def get_windows(self, pump_id: str, now: datetime) -> list[tuple[datetime, datetime]]:
+        """The chunks left to fetch for the pump. Only whole hours (or days) are fetched."""
+        step = self.get_resolution_step()
+        daily = step == timedelta(days=1)
+        # The api widens the range to whole days in its timezone. Whole hours are the same in
+        # utc, but days are aligned to local midnight, in wall time so DST days are 23 or 25h.
+        zone = ZoneInfo(API_TIMEZONE) if daily else timezone.utc
+        # Last complete window
+        end = now.astimezone(zone).replace(minute=0, second=0, microsecond=0)
+        if daily:
+            end = end.replace(hour=0)
+
+        start = self.get_checkpoint(pump_id)
+        if start is not None:
+            start = start.astimezone(zone)
+            if daily:
+                # Checkpoints of hourly windows, or of days in another timezone
+                start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        oldest = end - timedelta(days=self.config.max_age_days)
+        if start is None or start < oldest:
+            start = oldest
+
+        chunk = timedelta(hours=self.config.chunk_hours)
+        if daily:
+            chunk = timedelta(days=chunk.days)
+        if chunk < step:
+            chunk = step
+        windows = []
+        while start < end:
+            window_end = min(start + chunk, end)
+            windows.append((start, window_end))
+            start = window_end
+        return windows
+
+    def backfill_pump(self, pump_id: str):
+        windows = self.get_windows(pump_id, datetime.now(timezone.utc))
+        if windows:
+            log.info(f"Backfilling {len(windows)} chunks for {pump_id}")
+        for start, end in windows:
+            # The api includes the end of the range. Stop just before the next window.
+            metrics = self.api.get_pump_metric(pump_id, self.config.get_metrics(), start=start,
+                                               end=end - timedelta(milliseconds=1),
+                                               resolution=self.config.resolution)
+            if metrics is None:
+                # Resume from here on the next run
+                log.warning(
+                    f"Backfill of {pump_id} stopped at {start.isoformat()}")
+                return
+            self.publish(pump_id, self.config.resolution, metrics)
+            self.set_checkpoint(pump_id, end)
+
+    def run_once(self, pump_ids: list[str]):
+        with ThreadPoolExecutor(max_workers=max(1, self.config.concurrency),
+                                thread_name_prefix="q2m-backfill") as executor:
+            for pump_id, future in [(pump_id, executor.submit(self.backfill_pump, pump_id))
+                                    for pump_id in pump_ids]:
+                try:
+                    future.result()
+                except Exception:
+                    log.exception(f"Backfill of {pump_id} failed")
+
+    def run(self, get_pump_ids: Callable[[], list[str]]):
+        while True:
+            pump_ids = get_pump_ids()
+            if pump_ids:
+                self.run_once(pump_ids)
+            # Pick up the new complete windows every now and then, or the new pumps when woken up
+            self.wakeup.wait(self.config.interval)
+            self.wakeup.clear()
+
+    def trigger(self):
+        """Backfill now, e.g. when pumps have been configured."""
+        self.wakeup.set()
+
+    def start(self, get_pump_ids: Callable[[], list[str]]):
+        thread = threading.Thread(target=self.run, args=(get_pump_ids,),
+                                  name="q2m-backfill", daemon=True)
+        thread.start()
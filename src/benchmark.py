@@ -0,0 +1,229 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+log = logging.getLogger(__name__)
+
+
+def get_peak_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes elsewhere
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def get_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run_servers(pumps: int, latency: float, seed: int, ports, counters, stop):
+    """Run the mock cloud and the fake broker in their own process, so they don't add to the measurements."""
+    import random
+    from fake_broker import FakeBroker
+    from mock_server import MockCloud, start_server
+
+    random.seed(seed)
+    cloud = MockCloud(pumps=pumps, latency=latency)
+    server = start_server(cloud, "127.0.0.1", 0)
+    broker = FakeBroker()
+    ports[0] = server.server_address[1]
+    ports[1] = broker.start()
+    while not stop.wait(0.1):
+        counters[0] = broker.messages
+        counters[1] = broker.bytes
+
+
+def run_case(pumps: int, engine: str, cycles: int, interval: float, concurrency: int,
+             latency: float, seed: int, settings_document: bool) -> dict:
+    """Configure the pumps and poll them for a number of cycles. Runs in a fresh process."""
+    from config import Config, HomeAssistantConfig, MqttConfig, QvantumApiConfig
+    from exporter import API_RESPONSES, PUBLISHED_MESSAGES
+    from qvantum2mqtt import Qvantum2Mqtt
+
+    ports = multiprocessing.Array("i", 2)
+    counters = multiprocessing.Array("d", 2)
+    stop = multiprocessing.Event()
+    servers = multiprocessing.Process(target=run_servers, daemon=True,
+                                      args=(pumps, latency, seed, ports, counters, stop))
+    servers.start()
+    while ports[1] == 0:
+        time.sleep(0.05)
+
+    workdir = tempfile.mkdtemp(prefix="q2m-bench-")
+    with open(os.path.join(workdir, "auth.json"), "w") as f:
+        json.dump({"refresh_token": "benchmark"}, f)
+    # Every endpoint of every pump is due at the same time, so each cycle polls everything.
+    # Pumps that report they are offline would be polled offline_interval_factor times less
+    # often, and not be part of every cycle. No request budget, the pipeline itself is measured.
+    config = Config(
+        api=QvantumApiConfig(api_endpoint=f"http://127.0.0.1:{ports[0]}",
+                             auth_file_path=os.path.join(workdir, "auth.json"),
+                             inventory_cache_path=os.path.join(workdir, "inventory_cache.json"),
+                             open_browser=False,
+                             refresh_interval=interval, settings_interval=interval,
+                             alarms_interval=interval, metadata_interval=interval,
+                             offline_interval_factor=1, poll_jitter=0,
+                             poll_engine=engine, poll_concurrency=concurrency,
+                             http_pool_size=max(10, concurrency), rate_limit=0),
+        mqtt=MqttConfig(server="127.0.0.1", port=ports[1], settings_document=settings_document),
+        ha=HomeAssistantConfig(discovery_cache_path=os.path.join(workdir, "discovery_hashes.json")))
+
+    def get_published() -> float:
+        return sum(PUBLISHED_MESSAGES.values.values())
+
+    def get_requests() -> float:
+        # Counted in this process. The counters of the servers are only copied every 0.1s.
+        return sum(API_RESPONSES.values.values())
+
+    q2m = Qvantum2Mqtt(config)
+    start, cpu_start = time.monotonic(), time.process_time()
+    q2m.configure_devices()
+    configure = {"time": time.monotonic() - start,
+                 "cpu": time.process_time() - cpu_start,
+                 "messages": get_published()}
+    q2m.mqtt.loop_start()
+    # The pumps were added to the scheduler as they were configured. Line up their deadlines,
+    # so every cycle is a full sweep of the fleet.
+    with q2m.scheduler.lock:
+        now = time.monotonic()
+        for key in q2m.scheduler.deadlines:
+            q2m.scheduler.deadlines[key] = now
+
+    results = []
+    done = threading.Event()
+    publish_q2m_status = q2m.publish_q2m_status
+    last = {"cpu": time.process_time(), "messages": get_published(), "requests": get_requests()}
+
+    def on_cycle(cycle_time: float):
+        publish_q2m_status(cycle_time)
+        if done.is_set():
+            # Polls still running until the pumps are removed
+            return
+        cpu, messages, requests = time.process_time(), get_published(), get_requests()
+        results.append({"cycle_time": cycle_time,
+                        "cpu": cpu - last["cpu"],
+                        "messages": messages - last["messages"],
+                        "api_requests": requests - last["requests"]})
+        last.update(cpu=cpu, messages=messages, requests=requests)
+        if len(results) >= cycles:
+            done.set()
+
+    q2m.publish_q2m_status = on_cycle
+    threading.Thread(target=q2m.update_states, name="q2m-bench", daemon=True).start()
+    done.wait()
+    # Stop polling, and let the network loop deliver the last messages before reading the
+    # broker counters
+    for pump in q2m.devices:
+        q2m.scheduler.remove_pump(pump.id)
+    time.sleep(1)
+
+    cycle_times = [cycle["cycle_time"] for cycle in results]
+    messages = sum(cycle["messages"] for cycle in results)
+    result = {"pumps": pumps,
+              "engine": engine,
+              "settings_document": settings_document,
+              "concurrency": concurrency,
+              "configure_time": configure["time"],
+              "configure_cpu": configure["cpu"],
+              "configure_messages": configure["messages"],
+              "time_to_first_state": q2m.status.status.time_to_first_state,
+              "cycles": results,
+              "cycle_time_mean": statistics.mean(cycle_times),
+              "cycle_time_median": statistics.median(cycle_times),
+              "cycle_time_max": max(cycle_times),
+              "messages_per_cycle": messages / len(results),
+              "messages_per_second": messages / sum(cycle_times) if sum(cycle_times) else 0,
+              "cpu_per_cycle": statistics.mean(cycle["cpu"] for cycle in results),
+              "peak_rss_mb": get_peak_rss_mb(),
+              "broker_messages": counters[0],
+              "broker_bytes": counters[1]}
+    stop.set()
+    return result
+
+
+def run_case_process(queue, *args):
+    try:
+        queue.put(run_case(*args))
+    except Exception as e:
+        queue.put({"error": repr(e)})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the poll and publish pipeline against a mock cloud and a fake broker.")
+    parser.add_argument("--pumps", default="1,10,100,1000",
+                        help='Comma separated fleet sizes. Defaults to "1,10,100,1000".')
+    parser.add_argument("--engine", default="sync,async",
+                        help='Comma separated poll engines. Defaults to "sync,async".')
+    parser.add_argument("--cycles", type=int, default=5,
+                        help="Poll cycles to measure per case.")
+    parser.add_argument("--interval", type=float, default=1,
+                        help="Poll interval of all endpoints, in seconds.")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Concurrency of the async engine.")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Latency of the mock cloud, in seconds.")
+    parser.add_argument("--settings-document", action="store_true",
+                        help="Publish the settings of each pump as one document.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("-o", "--output", default="benchmark_results.json",
+                        help='Where to write the results. Defaults to "benchmark_results.json".')
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s - q2m-bench - %(levelname)s - %(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+
+    # Every case runs in a new process, so peak rss and cpu are not carried between cases
+    context = multiprocessing.get_context("spawn")
+    results = []
+    for engine in args.engine.split(","):
+        for pumps in [int(pumps) for pumps in args.pumps.split(",")]:
+            log.info(f"Running {pumps} pumps with the {engine} engine")
+            queue = context.Queue()
+            process = context.Process(target=run_case_process,
+                                      args=(queue, pumps, engine, args.cycles, args.interval,
+                                            args.concurrency, args.latency, args.seed,
+                                            args.settings_document))
+            process.start()
+            result = queue.get()
+            process.join()
+            if "error" in result:
+                log.error(f"{pumps} pumps with the {engine} engine failed: {result['error']}")
+                result.update(pumps=pumps, engine=engine)
+            else:
+                log.info(f"cycle {result['cycle_time_mean']:.3f}s, "
+                         f"{result['messages_per_second']:.0f} msgs/s, "
+                         f"cpu {result['cpu_per_cycle']:.3f}s/cycle, "
+                         f"rss {result['peak_rss_mb']:.1f} MB")
+            results.append(result)
+
+    output = {"timestamp": datetime.now(timezone.utc).isoformat(),
+              "revision": get_revision(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "settings": vars(args),
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    log.info(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
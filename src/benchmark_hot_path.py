@@ -0,0 +1,123 @@
+import argparse
+import json
+import platform
+import timeit
+
+from qvantum_classes import PumpSettingsResponse, PumpStatusResponse, SettingsDocument
+
+# The examples of heatpump-cloud-http-api.yaml, completed with the metadata and the full
+# set of metrics and settings a pump reports
+STATUS = json.dumps({
+    "connectivity": {"connected": True, "timestamp": "2024-03-11T20:52:25.728Z",
+                     "disconnect_reason": "client-disconnect"},
+    "metrics": {"time": "2024-03-18T22:15:41.006Z", "outdoor_temperature": -7.5,
+                "indoor_temperature": 16.5, "heating_flow_temperature": 18.3,
+                "heating_flow_temperature_target": 18.3, "tap_water_tank_temperature": 56.6,
+                "tap_water_capacity": 5, "tap_water_start": 50, "tap_water_stop": 60,
+                "compressorenergy": 20503.63, "additionalenergy": 1281.48},
+    "device_metadata": {"uptime_hours": 5629, "display_fw_version": "1.4.2",
+                        "cc_fw_version": "2.1.0", "inv_fw_version": "0.9.7"},
+}).encode("utf-8")
+
+SETTINGS = json.dumps({
+    "meta": {"last_reported": "2024-03-11T20:14:34.002Z", "validity": "valid_until",
+             "valid_until": "2024-03-22T14:34:02.000Z"},
+    "settings": [{"name": "indoor_temperature_target", "value": 21, "read_only": False},
+                 {"name": "tap_water_capacity_target", "value": 4, "read_only": False},
+                 {"name": "extra_tap_water", "value": "off", "read_only": False},
+                 {"name": "tap_water_start", "value": 50, "read_only": False},
+                 {"name": "tap_water_stop", "value": 60, "read_only": False},
+                 {"name": "indoor_temperature_offset", "value": 0, "read_only": False},
+                 {"name": "sensor_mode", "value": "bt2", "read_only": True},
+                 {"name": "vacation_mode", "value": "off", "read_only": False}],
+}).encode("utf-8")
+
+
+def to_str(value) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else value
+
+
+# What publish_status, publish_settings and publish_settings_document serialize every poll
+def status_payloads(status: PumpStatusResponse, dump) -> list:
+    return [dump(status.connectivity), dump(status.metrics)]
+
+
+def settings_payloads(settings: PumpSettingsResponse, dump) -> list:
+    return [dump(settings.meta)] + [dump(setting) for setting in settings.settings]
+
+
+def document_payloads(settings: PumpSettingsResponse, dump) -> list:
+    return [dump(SettingsDocument(meta=settings.meta,
+                                  settings={setting.name: setting for setting in settings.settings}))]
+
+
+def model_dump(model) -> str:
+    return model.model_dump_json()
+
+
+def fast_dump(model) -> bytes:
+    return model.dump_json_fast()
+
+
+CASES = {
+    "status": {
+        # How the responses were decoded before the raw bodies were kept
+        "dict": lambda: status_payloads(PumpStatusResponse(**json.loads(STATUS)), model_dump),
+        "validate": lambda: status_payloads(PumpStatusResponse.model_validate_json(STATUS), model_dump),
+        "fast": lambda: status_payloads(PumpStatusResponse.model_validate_json(STATUS), fast_dump),
+    },
+    "settings": {
+        "dict": lambda: settings_payloads(PumpSettingsResponse(**json.loads(SETTINGS)), model_dump),
+        "validate": lambda: settings_payloads(PumpSettingsResponse.model_validate_json(SETTINGS), model_dump),
+        "fast": lambda: settings_payloads(PumpSettingsResponse.model_validate_json(SETTINGS), fast_dump),
+    },
+    "document": {
+        "dict": lambda: document_payloads(PumpSettingsResponse(**json.loads(SETTINGS)), model_dump),
+        "validate": lambda: document_payloads(PumpSettingsResponse.model_validate_json(SETTINGS), model_dump),
+        "fast": lambda: document_payloads(PumpSettingsResponse.model_validate_json(SETTINGS), fast_dump),
+    },
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmark of decoding the polled responses and serializing the states, "
+                    "with and without fast_serialize.")
+    parser.add_argument("-n", "--number", type=int, default=20000,
+                        help="Iterations per measurement.")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="Measurements per case. The best one is reported.")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Also write the results as json to this file.")
+    args = parser.parse_args()
+
+    # All paths must publish exactly the same payloads
+    for payload, paths in CASES.items():
+        outputs = {json.dumps([to_str(value) for value in func()]) for func in paths.values()}
+        assert len(outputs) == 1, f"The payloads of {payload} differ between the paths"
+
+    results = []
+    for payload, paths in CASES.items():
+        timings = {path: min(timeit.repeat(func, number=args.number, repeat=args.repeat)) / args.number * 1e6
+                   for path, func in paths.items()}
+        for path, us_per_call in timings.items():
+            results.append({"payload": payload,
+                            "path": path,
+                            "us_per_call": us_per_call,
+                            "speedup_vs_validate": timings["validate"] / us_per_call})
+
+    print(f"{'payload':<10}{'path':<10}{'us/call':>10}{'vs validate':>14}")
+    for result in results:
+        print(f"{result['payload']:<10}{result['path']:<10}{result['us_per_call']:>10.2f}"
+              f"{result['speedup_vs_validate']:>13.2f}x")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(),
+                       "platform": platform.platform(),
+                       "settings": vars(args),
+                       "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
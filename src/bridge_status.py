@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from exporter import TIME_TO_FIRST_STATE
+from ha_classes import EndpointFreshness, PollTiming, PumpFreshness, PumpTiming, Q2mStatus
+
+log = logging.getLogger(__name__)
+
+# Close enough to the process start, the module is imported right away
+PROCESS_START = time.monotonic()
+
+
+class StatusTracker:
+    """
+    Collects the timing of every poll, split in time spent waiting for the api (fetch),
+    decoding the response (parse) and publishing the states (publish), together with the
+    last errors and the time from process start to the first published state.
+
+    The timings are kept per pump and endpoint, and published on a topic of each pump
+    when they change. The bridge summary is small, and published at most once per interval.
+    """
+
+    def __init__(self, start_time: float = PROCESS_START):
+        self.start_time = start_time
+        self.lock = threading.Lock()
+        self.status = Q2mStatus()
+        self.pumps: dict[str, PumpTiming] = {}
+        # Pumps polled since their timing was last published
+        self.changed: set[str] = set()
+        self.cycle_polls = 0
+        self.cycle_time = 0.0
+        self.summary_published: Optional[float] = None
+
+    def record(self, pump_id: str, endpoint: str, fetch: float, parse: float, publish: float,
+               error: Optional[str] = None):
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            pump = self.pumps.setdefault(pump_id, PumpTiming())
+            timing = pump.endpoints.setdefault(endpoint, PollTiming())
+            timing.fetch = fetch
+            timing.parse = parse
+            timing.publish = publish
+            timing.total = fetch + parse + publish
+            timing.timestamp = now
+            if error is None and pump.time_to_first_state is None:
+                pump.time_to_first_state = time.monotonic() - self.start_time
+                if self.status.time_to_first_state is None:
+                    self.status.time_to_first_state = pump.time_to_first_state
+                    TIME_TO_FIRST_STATE.set(pump.time_to_first_state)
+                    log.info(f"First state published {pump.time_to_first_state:.1f}s after start")
+            if error is not None:
+                timing.last_error = error
+                timing.last_error_timestamp = now
+                pump.last_error = f"{endpoint}: {error}"
+                pump.last_error_timestamp = now
+                self.status.last_error = f"{pump_id} {endpoint}: {error}"
+                self.status.last_error_timestamp = now
+            self.changed.add(pump_id)
+            self.cycle_polls += 1
+
+    def remove(self, pump_id: str):
+        with self.lock:
+            self.pumps.pop(pump_id, None)
+            self.changed.discard(pump_id)
+
+    def pop_changed(self) -> dict[str, PumpTiming]:
+        """Snapshots of the pumps polled since the last call."""
+        with self.lock:
+            changed = {pump_id: self.pumps[pump_id].model_copy(deep=True) for pump_id in self.changed}
+            self.changed.clear()
+            return changed
+
+    def end_cycle(self, cycle_time: float, interval: float) -> Optional[Q2mStatus]:
+        """
+        Close a batch of polls. Returns a snapshot of the bridge summary if it was last
+        published interval seconds ago or more, with the longest batch and the number of
+        polls since then. Else None.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.cycle_time = max(self.cycle_time, cycle_time)
+            if self.summary_published is not None and now - self.summary_published < interval:
+                return None
+            self.summary_published = now
+            self.status.cycle_time = self.cycle_time
+            self.status.cycle_polls = self.cycle_polls
+            self.status.pumps = len(self.pumps)
+            self.cycle_time = 0.0
+            self.cycle_polls = 0
+            return self.status.model_copy(deep=True)
+
+
+class FreshnessTracker:
+    """
+    Keeps when every endpoint of every pump was last polled successfully, and if the last
+    poll failed or was skipped. Lets HA tell a cloud that is down (stale states) apart
+    from a pump that is offline (fresh states saying it is disconnected).
+    """
+
+    def __init__(self, main_endpoint: str):
+        # The endpoint that gives the age of the pump as a whole
+        self.main_endpoint = main_endpoint
+        self.lock = threading.Lock()
+        # {pump_id: {endpoint: freshness}}
+        self.pumps: dict[str, dict[str, EndpointFreshness]] = {}
+
+    def set(self, pump_id: str, endpoint: str, fresh: bool) -> bool:
+        """Record the outcome of a poll. True if the endpoint changed between fresh and stale."""
+        with self.lock:
+            endpoints = self.pumps.setdefault(pump_id, {})
+            freshness = endpoints.get(endpoint)
+            changed = freshness is None or freshness.stale == fresh
+            if freshness is None:
+                freshness = endpoints[endpoint] = EndpointFreshness()
+            freshness.stale = not fresh
+            if fresh:
+                freshness.last_update = datetime.now(timezone.utc)
+            return changed
+
+    def get(self, pump_id: str, breakers: dict[str, str]) -> PumpFreshness:
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            endpoints = {name: freshness.model_copy(update={
+                "age": (now - freshness.last_update).total_seconds() if freshness.last_update else None,
+                "breaker": breakers.get(name)})
+                for name, freshness in self.pumps.get(pump_id, {}).items()}
+        main = endpoints.get(self.main_endpoint, EndpointFreshness())
+        return PumpFreshness(stale=any(freshness.stale for freshness in endpoints.values()),
+                             age=main.age, last_update=main.last_update, endpoints=endpoints)
+
+    def remove(self, pump_id: str):
+        with self.lock:
+            self.pumps.pop(pump_id, None)
@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from enum import Enum
+
+from exporter import CIRCUIT_BREAKER_STATE
+
+log = logging.getLogger(__name__)
+
+
+class BreakerState(str, Enum):
+    CLOSED = "closed"
+    HALF_OPEN = "half_open"
+    OPEN = "open"
+
+
+# Gauge values of the states
+BREAKER_STATE_VALUES = {BreakerState.CLOSED: 0, BreakerState.HALF_OPEN: 1, BreakerState.OPEN: 2}
+
+
+class CircuitBreaker:
+    """
+    Stops polling an endpoint of the api that keeps failing.
+
+    After threshold failures in a row (for any pump) the breaker opens, and no requests
+    are sent to the endpoint for a backoff time. Then it is half open: a single poll is
+    let through as a probe. If the probe succeeds the breaker closes, otherwise it opens
+    again for twice as long, up to max_backoff. A threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, name: str, threshold: int, backoff: float, max_backoff: float):
+        self.name = name
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        # Times opened since it was last closed. Doubles the backoff every time.
+        self.trips = 0
+        self.open_until = 0.0
+        self.probing = False
+        CIRCUIT_BREAKER_STATE.set(0, endpoint=name)
+
+    def set_state(self, state: BreakerState):
+        self.state = state
+        CIRCUIT_BREAKER_STATE.set(BREAKER_STATE_VALUES[state], endpoint=self.name)
+
+    def is_open(self) -> bool:
+        """True if a poll would not be let through now. Doesn't use up the probe."""
+        with self.lock:
+            if self.state == BreakerState.OPEN:
+                return time.monotonic() < self.open_until
+            return self.state == BreakerState.HALF_OPEN and self.probing
+
+    def allow(self) -> bool:
+        """Check if a poll may be sent. When half open, only the first caller gets to probe."""
+        if self.threshold <= 0:
+            return True
+        with self.lock:
+            if self.state == BreakerState.OPEN and time.monotonic() >= self.open_until:
+                log.info(f"Probing the {self.name} endpoint")
+                self.set_state(BreakerState.HALF_OPEN)
+                self.probing = False
+            if self.state == BreakerState.CLOSED:
+                return True
+            if self.state == BreakerState.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            if self.state != BreakerState.CLOSED:
+                log.warning(f"The {self.name} endpoint is back. Polling again.")
+            self.set_state(BreakerState.CLOSED)
+            self.failures = 0
+            self.trips = 0
+            self.probing = False
+
+    def record_failure(self):
+        if self.threshold <= 0:
+            return
+        with self.lock:
+            self.failures += 1
+            if self.state == BreakerState.OPEN:
+                # A poll that was already in flight when the breaker opened
+                return
+            if self.state == BreakerState.CLOSED and self.failures < self.threshold:
+                return
+            self.trips += 1
+            backoff = min(self.backoff * 2 ** (self.trips - 1), self.max_backoff)
+            self.open_until = time.monotonic() + backoff
+            self.probing = False
+            self.set_state(BreakerState.OPEN)
+            log.warning(f"The {self.name} endpoint failed {self.failures} times in a row. "
+                        f"Not polling it for {backoff:.0f}s.")
@@ -0,0 +1,222 @@
+import bisect
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from pydantic import ValidationError
+
+from config import ClusterConfig
+from ha_classes import InstanceState, PumpLease
+from mqtt import MqttClient
+
+log = logging.getLogger(__name__)
+
+
+def get_instance_topic(config: ClusterConfig, instance_id: str) -> str:
+    return f"{config.topic}/instances/{instance_id}"
+
+
+def get_lease_topic(config: ClusterConfig, pump_id: str) -> str:
+    return f"{config.topic}/leases/{pump_id}"
+
+
+class HashRing:
+    """
+    Consistent hashing of pumps onto instances. Every instance is placed on the ring a
+    number of times (virtual nodes), so the pumps are spread evenly, and an instance
+    joining or leaving only moves the pumps next to its own nodes.
+    """
+
+    def __init__(self, instances: list[str], virtual_nodes: int):
+        self.ring = sorted((self.get_hash(f"{instance}#{index}"), instance)
+                           for instance in instances for index in range(virtual_nodes))
+        self.keys = [key for key, _ in self.ring]
+
+    @staticmethod
+    def get_hash(value: str) -> int:
+        # Not hash(), it differs between processes
+        return int.from_bytes(hashlib.sha1(value.encode("utf-8")).digest()[:8], "big")
+
+    def get_owner(self, pump_id: str) -> Optional[str]:
+        if not self.ring:
+            return None
+        index = bisect.bisect(self.keys, self.get_hash(pump_id)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class ClusterCoordinator:
+    """
+    Spreads the pumps over the bridge instances connected to the same broker, so that
+    every pump is polled by exactly one live instance.
+
+    Every instance publishes a retained heartbeat on its instance topic, with the last
+    will Q2mState(running=False) on the same topic. The pumps are placed on the live
+    instances with consistent hashing. An instance claims a pump by publishing a retained
+    lease on the lease topic of the pump, and only polls the pump once the broker has
+    sent the lease back, so the broker decides if two instances claim at the same time.
+    A pump that moves to another instance is released by clearing its lease, which the
+    new owner then claims. When an instance dies, its last will (or a heartbeat older
+    than lease_timeout) drops it from the ring and its pumps are claimed right away.
+    """
+
+    def __init__(self, config: ClusterConfig, instance_id: str, mqtt: MqttClient,
+                 on_acquired: Callable[[list[str]], None], on_released: Callable[[list[str]], None]):
+        self.config = config
+        self.instance_id = instance_id
+        self.mqtt = mqtt
+        self.on_acquired = on_acquired
+        self.on_released = on_released
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # Heartbeats of all instances, including this one
+        self.members: dict[str, InstanceState] = {}
+        # Holder of the lease of each pump, as last sent by the broker
+        self.leases: dict[str, str] = {}
+        # Pumps of the accounts, and the pumps polled by this instance
+        self.pumps: set[str] = set()
+        self.owned: set[str] = set()
+        # Claims and releases sent but not yet seen back. Not sent again meanwhile.
+        self.pending: dict[str, float] = {}
+        # Configuring pumps takes a while. Done in order, off the coordinator thread.
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="q2m-cluster")
+        self.joined: Optional[float] = None
+        self.last_heartbeat = 0.0
+        self.mqtt.add_topic_handler(f"{config.topic}/instances/+", self.handle_instance)
+        self.mqtt.add_topic_handler(f"{config.topic}/leases/+", self.handle_lease)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="q2m-cluster", daemon=True)
+        thread.start()
+
+    def add_pumps(self, pump_ids: list[str]):
+        with self.lock:
+            self.pumps.update(pump_ids)
+        self.wakeup.set()
+
+    def is_owned(self, pump_id: str) -> bool:
+        with self.lock:
+            return pump_id in self.owned
+
+    def handle_instance(self, topic: str, payload: bytes):
+        instance_id = topic.split("/")[-1]
+        state = None
+        if payload:
+            try:
+                state = InstanceState.model_validate_json(payload)
+            except ValidationError as e:
+                log.warning(f"Invalid heartbeat from {instance_id}: {e!r}")
+        with self.lock:
+            if state is None or not state.running:
+                # Last will, or a clean shutdown. Don't wait for the heartbeat to time out.
+                if self.members.pop(instance_id, None) is not None:
+                    log.info(f"Instance {instance_id} left the cluster")
+            else:
+                if instance_id not in self.members:
+                    log.info(f"Instance {instance_id} joined the cluster")
+                self.members[instance_id] = state
+        self.wakeup.set()
+
+    def handle_lease(self, topic: str, payload: bytes):
+        pump_id = topic.split("/")[-1]
+        holder = None
+        if payload:
+            try:
+                holder = PumpLease.model_validate_json(payload).instance_id
+            except ValidationError as e:
+                log.warning(f"Invalid lease for {pump_id}: {e!r}")
+        with self.lock:
+            if holder is None:
+                self.leases.pop(pump_id, None)
+            else:
+                self.leases[pump_id] = holder
+            self.pending.pop(pump_id, None)
+        self.wakeup.set()
+
+    def get_live_instances(self) -> list[str]:
+        now = time.time()
+        with self.lock:
+            live = {instance_id for instance_id, state in self.members.items()
+                    if now - state.heartbeat < self.config.lease_timeout}
+        live.add(self.instance_id)
+        return sorted(live)
+
+    def publish_heartbeat(self):
+        with self.lock:
+            pumps = len(self.owned)
+        state = InstanceState(heartbeat=time.time(), pumps=pumps)
+        self.mqtt.publish_msg(get_instance_topic(self.config, self.instance_id),
+                              state.model_dump_json(), retain=True)
+        self.last_heartbeat = time.monotonic()
+
+    def release_all(self):
+        with self.lock:
+            released = sorted(self.owned)
+            self.owned.clear()
+            self.pending.clear()
+        if released:
+            log.warning(f"Lost the broker. Stopped polling {len(released)} pumps.")
+            self.executor.submit(self.on_released, released)
+
+    def rebalance(self):
+        """Claim the pumps this instance should poll, and hand over the others."""
+        live = self.get_live_instances()
+        ring = HashRing(live, self.config.virtual_nodes)
+        now = time.monotonic()
+        claims, releases, acquired, released = [], [], [], []
+        with self.lock:
+            for pump_id in self.pumps:
+                owner = ring.get_owner(pump_id)
+                holder = self.leases.get(pump_id)
+                if holder == self.instance_id and owner == self.instance_id:
+                    if pump_id not in self.owned:
+                        self.owned.add(pump_id)
+                        acquired.append(pump_id)
+                    continue
+                if pump_id in self.owned:
+                    self.owned.discard(pump_id)
+                    released.append(pump_id)
+                if self.pending.get(pump_id, 0) > now:
+                    continue
+                if owner == self.instance_id and (holder is None or holder not in live):
+                    claims.append(pump_id)
+                elif owner != self.instance_id and holder == self.instance_id:
+                    releases.append(pump_id)
+                else:
+                    continue
+                # If the broker never sends it back, try again after a heartbeat
+                self.pending[pump_id] = now + self.config.heartbeat_interval
+
+        # Stop polling before the lease is released, so the new owner never overlaps
+        if released:
+            log.info(f"Handing over {len(released)} pumps")
+            self.executor.submit(self.on_released, sorted(released))
+        for pump_id in releases:
+            self.mqtt.clear_topic(get_lease_topic(self.config, pump_id))
+        for pump_id in claims:
+            lease = PumpLease(instance_id=self.instance_id, timestamp=time.time())
+            self.mqtt.publish_msg(get_lease_topic(self.config, pump_id),
+                                  lease.model_dump_json(), retain=True)
+        if acquired:
+            log.info(f"Acquired {len(acquired)} pumps")
+            self.executor.submit(self.on_acquired, sorted(acquired))
+
+    def run(self):
+        while True:
+            if not self.mqtt.connected:
+                self.joined = None
+                self.release_all()
+            else:
+                if self.joined is None:
+                    # Learn the other instances and leases from the retained messages first
+                    self.joined = time.monotonic()
+                    self.publish_heartbeat()
+                    log.info(f"Joining the cluster as {self.instance_id}")
+                if time.monotonic() - self.last_heartbeat >= self.config.heartbeat_interval:
+                    self.publish_heartbeat()
+                if time.monotonic() - self.joined >= self.config.join_delay:
+                    self.rebalance()
+            self.wakeup.wait(min(self.config.heartbeat_interval, self.config.join_delay))
+            self.wakeup.clear()
@@ -0,0 +1,141 @@
+import heapq
+import logging
+import queue
+import threading
+import time
+import zlib
+from typing import Any, Callable, Optional
+
+from exporter import COMMAND_DURATION, COMMAND_QUEUE_DEPTH, COMMAND_WAIT
+from ha_classes import CommandStats
+
+log = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """
+    A fixed number of worker threads. Jobs with the same key always run on the same
+    worker, in the order they were submitted.
+    """
+
+    def __init__(self, workers: int, on_job_done: Optional[Callable[[CommandStats], None]] = None):
+        self.on_job_done = on_job_done
+        self.queues: list[queue.Queue] = [queue.Queue() for _ in range(max(1, workers))]
+        self.stats = CommandStats()
+        self.stats_lock = threading.Lock()
+        for index, jobs in enumerate(self.queues):
+            thread = threading.Thread(target=self.run, args=(jobs,),
+                                      name=f"q2m-command-{index}", daemon=True)
+            thread.start()
+
+    def submit(self, key: str, func: Callable, *args):
+        index = zlib.crc32(key.encode("utf-8")) % len(self.queues)
+        with self.stats_lock:
+            self.stats.queue_depth += 1
+            COMMAND_QUEUE_DEPTH.set(self.stats.queue_depth)
+        self.queues[index].put((time.monotonic(), func, args))
+
+    def run(self, jobs: queue.Queue):
+        while True:
+            enqueued, func, args = jobs.get()
+            start = time.monotonic()
+            failed = False
+            try:
+                func(*args)
+            except Exception:
+                log.exception("Command failed")
+                failed = True
+            end = time.monotonic()
+
+            COMMAND_WAIT.observe(start - enqueued)
+            COMMAND_DURATION.observe(end - start)
+            with self.stats_lock:
+                self.stats.queue_depth -= 1
+                COMMAND_QUEUE_DEPTH.set(self.stats.queue_depth)
+                self.stats.completed += 1
+                if failed:
+                    self.stats.failed += 1
+                self.stats.last_wait = start - enqueued
+                self.stats.last_duration = end - start
+                self.stats.max_wait = max(self.stats.max_wait, self.stats.last_wait)
+                self.stats.max_duration = max(self.stats.max_duration, self.stats.last_duration)
+                stats = self.stats.model_copy()
+            if self.on_job_done is not None:
+                self.on_job_done(stats)
+
+    def get_stats(self) -> CommandStats:
+        with self.stats_lock:
+            return self.stats.model_copy()
+
+
+class CommandQueue:
+    """
+    Coalesces setting commands per pump and sends them as one batched request.
+
+    The first command for a pump opens a debounce window. Commands that arrive within
+    the window are merged, and only the latest value of each setting is kept. When the
+    window closes, all pending settings of the pump are sent together on a worker pool.
+    The commands of a pump always run on the same worker, so a later value can't
+    overtake an earlier one, and a slow api never blocks the caller (the mqtt loop).
+    """
+
+    def __init__(self, send: Callable[[str, dict[str, Any]], Any], debounce: float, pool: WorkerPool):
+        self.send = send
+        # Called with the pump id, the settings and the api response (None if failed) after each request
+        self.on_sent: Optional[Callable[[str, dict[str, Any], Any], None]] = None
+        self.debounce = debounce
+        self.pool = pool
+        self.condition = threading.Condition()
+        self.pending: dict[str, dict[str, Any]] = {}
+        # Debounce deadline of each pump with pending settings
+        self.deadlines: list[tuple[float, str]] = []
+        # Pumps with a request queued or in flight. New commands wait for it to complete.
+        self.busy: set[str] = set()
+        thread = threading.Thread(target=self.run, name="q2m-command-dispatch", daemon=True)
+        thread.start()
+
+    def put(self, pump_id: str, setting: str, value: Any):
+        with self.condition:
+            settings = self.pending.get(pump_id)
+            if settings is None:
+                settings = self.pending[pump_id] = {}
+                if pump_id not in self.busy:
+                    self.add_deadline(pump_id)
+            elif setting in settings:
+                log.debug(f"Replacing pending {setting} on {pump_id}")
+            settings[setting] = value
+
+    def add_deadline(self, pump_id: str):
+        heapq.heappush(self.deadlines, (time.monotonic() + self.debounce, pump_id))
+        self.condition.notify()
+
+    def run(self):
+        # Hand over pumps to the worker pool when their debounce window closes
+        while True:
+            with self.condition:
+                while not self.deadlines:
+                    self.condition.wait()
+                deadline, pump_id = self.deadlines[0]
+                timeout = deadline - time.monotonic()
+                if timeout > 0:
+                    self.condition.wait(timeout)
+                    continue
+                heapq.heappop(self.deadlines)
+                self.busy.add(pump_id)
+            self.pool.submit(pump_id, self.flush, pump_id)
+
+    def flush(self, pump_id: str):
+        with self.condition:
+            settings = self.pending.pop(pump_id, {})
+        try:
+            if settings:
+                log.info(f"Setting {settings} on {pump_id}")
+                response = self.send(pump_id, settings)
+                if self.on_sent is not None:
+                    self.on_sent(pump_id, settings, response)
+        finally:
+            with self.condition:
+                self.busy.discard(pump_id)
+                # Commands that arrived during the request go in the next one
+                if pump_id in self.pending:
+                    self.add_deadline(pump_id)
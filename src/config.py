@@ -1,11 +1,14 @@
 
 
+from typing import Optional
 from pydantic import BaseModel
 import configparser
+import socket
 
 
 class HomeAssistantConfig(BaseModel):
     topic_prefix: str = "homeassistant"
+    discovery_cache_path: str = "discovery_hashes.json"
 
 
 class MqttConfig(BaseModel):
@@ -13,6 +16,12 @@ class MqttConfig(BaseModel):
     port: int = 1883
     user: str = None
     password: str = None
+    publish_cache: bool = True
+    republish_interval: int = 300
+    command_debounce: float = 0.5
+    command_workers: int = 4
+    settings_document: bool = False
+    fast_serialize: bool = False
 
 
 class QvantumApiConfig(BaseModel):
@@ -20,17 +29,115 @@ class QvantumApiConfig(BaseModel):
     port: int = 5173
     redirect: str = "http://localhost"
     auth_file_path: str = "auth_tokens.json"
+    inventory_cache_path: str = "inventory_cache.json"
+    inventory_cache_ttl: int = 86400
     auth_server: str = "https://account.qvantum.com"
     client_id: str = "qvantum2mqtt"
     state: str = "abc123"
     open_browser: bool = True
     refresh_interval: int = 30
+    settings_interval: int = 120
+    alarms_interval: int = 300
+    metadata_interval: int = 3600
+    offline_interval_factor: float = 4
+    poll_jitter: float = 5
+    command_refresh_delay: float = 2
+    poll_engine: str = "sync"
+    poll_concurrency: int = 8
+    http_pool_size: int = 10
+    configure_concurrency: int = 4
+    connect_timeout: float = 5
+    read_timeout: float = 30
+    token_refresh_margin: int = 60
+    rate_limit: float = 10
+    rate_limit_burst: int = 20
+    rate_limit_retries: int = 1
+    retry_after_default: float = 30
+    breaker_threshold: int = 5
+    breaker_backoff: float = 30
+    breaker_max_backoff: float = 900
+    cache_ttls: str = "inventory/v1/devices/{id}/settings=3600,inventory/v1/devices/{id}/metrics=3600," \
+                      "inventory/v1/devices/{id}/alarms=3600,device-info/v1/devices/{id}/settings=0"
+
+    def get_cache_ttls(self) -> dict[str, float]:
+        ttls = {}
+        for item in self.cache_ttls.split(","):
+            if "=" not in item:
+                continue
+            endpoint, ttl = item.split("=", 1)
+            ttls[endpoint.strip().strip("/")] = float(ttl)
+        return ttls
+
+
+class AccountConfig(BaseModel):
+    # Overrides of the [api] section for one account
+    auth_file_path: str
+    api_endpoint: Optional[str] = None
+    port: Optional[int] = None
+
+
+class BackfillConfig(BaseModel):
+    enabled: bool = False
+    checkpoint_path: str = "backfill_checkpoints.json"
+    metrics: str = "compressorenergy,indoor_temperature,tap_water_capacity,additionalenergy"
+    resolution: str = "hourly"
+    chunk_hours: int = 24
+    max_age_days: int = 7
+    concurrency: int = 2
+    interval: int = 3600
+
+    def get_metrics(self) -> list[str]:
+        return [metric.strip() for metric in self.metrics.split(",") if metric.strip()]
+
+
+class TsdbConfig(BaseModel):
+    enabled: bool = False
+    path: str = "metrics.db"
+    batch_size: int = 500
+    flush_interval: int = 60
+    raw_retention_days: int = 7
+    hourly_retention_days: int = 90
+    daily_retention_days: int = 730
+    max_points: int = 5000
+    request_topic: str = "qvantum/q2m/history/request"
+    response_topic: str = "qvantum/q2m/history/response"
+
+
+class MetricsConfig(BaseModel):
+    enabled: bool = False
+    address: str = "0.0.0.0"
+    port: int = 9842
+
+
+class ClusterConfig(BaseModel):
+    enabled: bool = False
+    instance_id: str = ""
+    topic: str = "qvantum/q2m/cluster"
+    heartbeat_interval: float = 5
+    lease_timeout: float = 20
+    join_delay: float = 3
+    virtual_nodes: int = 64
+
+    def get_instance_id(self) -> str:
+        return self.instance_id or socket.gethostname()
 
 
 class Config(BaseModel):
     api: QvantumApiConfig
     mqtt: MqttConfig
     ha: HomeAssistantConfig
+    backfill: BackfillConfig = BackfillConfig()
+    tsdb: TsdbConfig = TsdbConfig()
+    metrics: MetricsConfig = MetricsConfig()
+    cluster: ClusterConfig = ClusterConfig()
+    accounts: dict[str, AccountConfig] = {}
+
+    def get_api_configs(self) -> dict[str, QvantumApiConfig]:
+        """The api config of every account. Only the [api] section if no accounts are configured."""
+        if not self.accounts:
+            return {"default": self.api}
+        return {name: self.api.model_copy(update=account.model_dump(exclude_none=True))
+                for name, account in self.accounts.items()}
 
 
 def load_config(config_path: str = "config.ini") -> Config:
@@ -38,4 +145,8 @@ def load_config(config_path: str = "config.ini") -> Config:
     config = configparser.ConfigParser()
     with open(config_path) as fd:
         config.read_file(fd)
-    return Config(**config)
+    # Every [account.<name>] section is one account
+    sections = dict(config)
+    accounts = {name[len("account."):]: sections.pop(name)
+                for name in list(sections) if name.startswith("account.")}
+    return Config(**sections, accounts=accounts)
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from files import write_file_atomic
+
+log = logging.getLogger(__name__)
+
+
+class DiscoveryManager:
+    """
+    Keeps track of the home assistant discovery configs that are retained on the broker.
+
+    A hash of every published config payload is stored in a local file. On the next start
+    only new or changed configs are published, and configs that are no longer deployed
+    (e.g. a setting removed from the inventory) can be cleared from the broker.
+    An empty path disables the store, and every config is published on each start.
+    The configs of this run are kept, to publish them again if the broker or HA lost them.
+    """
+
+    def __init__(self, path: str, broker: str):
+        self.path = path
+        # The hashes are only valid for the broker they were published to
+        self.broker = broker
+        self.lock = threading.Lock()
+        self.hashes: dict[str, str] = {}
+        # Config payloads deployed during this run, by topic
+        self.deployed: dict[str, str] = {}
+        self.load()
+
+    @staticmethod
+    def get_hash(payload: str) -> str:
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning(f"Could not read discovery store {self.path}: {e!r}")
+            return
+        if data.get("broker") != self.broker:
+            log.info("Broker changed since last run. Republishing all discovery configs.")
+            return
+        self.hashes = data.get("hashes", {})
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            data = json.dumps({"broker": self.broker, "hashes": self.hashes})
+        try:
+            write_file_atomic(self.path, data)
+        except OSError as e:
+            log.warning(f"Could not write discovery store {self.path}: {e!r}")
+
+    def is_changed(self, topic: str, payload: str) -> bool:
+        with self.lock:
+            self.deployed[topic] = payload
+            return self.hashes.get(topic) != self.get_hash(payload)
+
+    def set_published(self, topic: str, payload: str):
+        with self.lock:
+            self.hashes[topic] = self.get_hash(payload)
+
+    def forget(self, pump_ids: list[str]):
+        """
+        Publish the configs of the pumps again, even if unchanged. E.g. when another bridge
+        instance published its own configs for the pumps meanwhile. The topics are kept,
+        so stale configs are still pruned.
+        """
+        pump_ids = set(pump_ids)
+        with self.lock:
+            for topic in self.hashes:
+                if topic.split("/")[-3] in pump_ids:
+                    self.hashes[topic] = ""
+            for topic in [topic for topic in self.deployed if topic.split("/")[-3] in pump_ids]:
+                del self.deployed[topic]
+
+    def get_deployed(self) -> dict[str, str]:
+        with self.lock:
+            return dict(self.deployed)
+
+    def set_cleared(self, topic: str):
+        with self.lock:
+            self.hashes.pop(topic, None)
+
+    def get_stale_topics(self, pump_ids: list[str]) -> list[str]:
+        """
+        Config topics of the pumps that were published on an earlier run, but not deployed
+        on this one. Config topics are on the form <prefix>/<type>/<pump_id>/<name>/config.
+        """
+        pump_ids = set(pump_ids)
+        with self.lock:
+            return [topic for topic in self.hashes
+                    if topic.split("/")[-3] in pump_ids and topic not in self.deployed]
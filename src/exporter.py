@@ -0,0 +1,237 @@
+import logging
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    labels = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        self.lock = threading.Lock()
+
+    def get_label_values(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def get_family_name(self, openmetrics: bool) -> str:
+        return self.name
+
+    def render(self, openmetrics: bool) -> list[str]:
+        family = self.get_family_name(openmetrics)
+        lines = [f"# HELP {family} {self.documentation}",
+                 f"# TYPE {family} {self.type}"]
+        lines.extend(self.render_samples())
+        return lines
+
+    def render_samples(self) -> list[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.get_label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(self.get_label_values(labels), 0)
+
+    def get_family_name(self, openmetrics: bool) -> str:
+        # In OpenMetrics the family name of a counter has no _total suffix
+        if openmetrics and self.name.endswith("_total"):
+            return self.name[:-len("_total")]
+        return self.name
+
+    def render_samples(self) -> list[str]:
+        with self.lock:
+            values = dict(self.values)
+        return [f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}"
+                for key, value in values.items()]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.get_label_values(labels)] = value
+
+    def get(self, **labels) -> float:
+        with self.lock:
+            return self.values.get(self.get_label_values(labels), 0)
+
+    def render_samples(self) -> list[str]:
+        with self.lock:
+            values = dict(self.values)
+        return [f"{self.name}{format_labels(self.label_names, key)} {format_value(value)}"
+                for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # {labels: (bucket counts, sum, count)}
+        self.values: dict[tuple[str, ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.get_label_values(labels)
+        with self.lock:
+            counts, total, count = self.values.get(
+                key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def get_count(self, **labels) -> int:
+        with self.lock:
+            values = self.values.get(self.get_label_values(labels))
+        return values[2] if values is not None else 0
+
+    def render_samples(self) -> list[str]:
+        with self.lock:
+            values = {key: (list(counts), total, count)
+                      for key, (counts, total, count) in self.values.items()}
+        lines = []
+        for key, (counts, total, count) in values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                le = f'le="{"+Inf" if bound == math.inf else repr(float(bound))}"'
+                lines.append(
+                    f"{self.name}_bucket{format_labels(self.label_names, key, le)} {bucket_count}")
+            labels = format_labels(self.label_names, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, openmetrics: bool = False) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(openmetrics))
+        if openmetrics:
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+API_REQUEST_DURATION = REGISTRY.register(Histogram(
+    "q2m_api_request_duration_seconds", "Latency of requests to the Qvantum api.", ("endpoint",)))
+API_RESPONSES = REGISTRY.register(Counter(
+    "q2m_api_responses_total", "Responses from the Qvantum api by status code. Code is error if no response.",
+    ("endpoint", "code")))
+POLL_DURATION = REGISTRY.register(Histogram(
+    "q2m_poll_duration_seconds", "Time to poll and publish one endpoint of a pump.", ("endpoint",)))
+POLL_CYCLE_DURATION = REGISTRY.register(Histogram(
+    "q2m_poll_cycle_duration_seconds", "Time to poll and publish everything due in one poll cycle.",
+    buckets=DEFAULT_BUCKETS + (120, 300)))
+API_CACHE_REQUESTS = REGISTRY.register(Counter(
+    "q2m_api_cache_requests_total",
+    "Cacheable api requests by result: hit, miss, revalidated (304) or coalesced with a call in flight.",
+    ("endpoint", "result")))
+RATE_LIMIT_WAIT = REGISTRY.register(Histogram(
+    "q2m_api_rate_limit_wait_seconds", "Time requests wait for the request budget.", ("priority",)))
+CIRCUIT_BREAKER_STATE = REGISTRY.register(Gauge(
+    "q2m_circuit_breaker_state", "State of the circuit breaker of each endpoint. 0 closed, 1 half open, 2 open.",
+    ("endpoint",)))
+PUBLISHED_MESSAGES = REGISTRY.register(Counter(
+    "q2m_mqtt_published_messages_total", "Messages published to the broker.", ("category",)))
+PUBLISHED_BYTES = REGISTRY.register(Counter(
+    "q2m_mqtt_published_bytes_total", "Payload bytes published to the broker.", ("category",)))
+SKIPPED_MESSAGES = REGISTRY.register(Counter(
+    "q2m_mqtt_skipped_messages_total", "State messages not published since unchanged.", ("category",)))
+TOKEN_REFRESHES = REGISTRY.register(Counter(
+    "q2m_token_refreshes_total", "Access token refreshes.", ("result",)))
+TIME_TO_FIRST_STATE = REGISTRY.register(Gauge(
+    "q2m_time_to_first_state_seconds", "Time from process start to the first published state."))
+COMMAND_QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "q2m_command_queue_depth", "Commands queued or running on the worker pool."))
+COMMAND_WAIT = REGISTRY.register(Histogram(
+    "q2m_command_wait_seconds", "Time commands wait in the queue before running."))
+COMMAND_DURATION = REGISTRY.register(Histogram(
+    "q2m_command_duration_seconds", "Time to run a command."))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        openmetrics = "application/openmetrics-text" in self.headers.get(
+            "Accept", "")
+        body = REGISTRY.render(openmetrics).encode("utf-8")
+        content_type = "application/openmetrics-text; version=1.0.0; charset=utf-8" if openmetrics \
+            else "text/plain; version=0.0.4; charset=utf-8"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def start_server(address: str, port: int) -> Optional[ThreadingHTTPServer]:
+    try:
+        server = ThreadingHTTPServer((address, port), MetricsHandler)
+    except OSError as e:
+        log.error(f"Could not start the metrics server on {address}:{port}: {e!r}")
+        return None
+    server.daemon_threads = True
+    thread = threading.Thread(
+        target=server.serve_forever, name="q2m-metrics", daemon=True)
+    thread.start()
+    log.info(f"Serving metrics on http://{address}:{port}/metrics")
+    return server
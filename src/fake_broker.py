@@ -0,0 +1,207 @@
+import asyncio
+import logging
+import struct
+import threading
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+# Packet types
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def encode_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        encoded.append(byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def encode_string(value: bytes) -> bytes:
+    return struct.pack("!H", len(value)) + value
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_parts = topic_filter.split("/")
+    topic_parts = topic.split("/")
+    for index, part in enumerate(filter_parts):
+        if part == "#":
+            return True
+        if index >= len(topic_parts) or (part != "+" and part != topic_parts[index]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+class Session:
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.subscriptions: set[str] = set()
+        # (topic, payload, retain)
+        self.will: Optional[tuple[str, bytes, bool]] = None
+
+
+class FakeBroker:
+    """
+    Minimal MQTT 3.1.1 broker, for benchmarks and offline tests.
+
+    Supports connect with last will, publish (always delivered as qos 0), retained
+    messages, subscriptions with wildcards and keep alive. No authentication, sessions
+    or persistence. Counts the messages and payload bytes it receives.
+    """
+
+    def __init__(self, address: str = "127.0.0.1", port: int = 0):
+        self.address = address
+        self.port = port
+        self.sessions: set[Session] = set()
+        self.retained: dict[str, bytes] = {}
+        self.messages = 0
+        self.bytes = 0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.started = threading.Event()
+
+    async def read_packet(self, reader: asyncio.StreamReader) -> tuple[int, int, bytes]:
+        header = (await reader.readexactly(1))[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await reader.readexactly(length) if length else b""
+        return header >> 4, header & 0x0F, body
+
+    def send(self, session: Session, packet_type: int, flags: int, body: bytes):
+        session.writer.write(bytes([(packet_type << 4) | flags]) + encode_length(len(body)) + body)
+
+    def route(self, topic: str, payload: bytes, retain: bool):
+        self.messages += 1
+        self.bytes += len(payload)
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        body = encode_string(topic.encode("utf-8")) + payload
+        for session in self.sessions:
+            if any(topic_matches(topic_filter, topic) for topic_filter in session.subscriptions):
+                self.send(session, PUBLISH, 0, body)
+
+    def handle_connect(self, session: Session, body: bytes):
+        offset = 2 + struct.unpack("!H", body[:2])[0] + 1
+        flags = body[offset]
+        offset += 3
+        client_id_length = struct.unpack("!H", body[offset:offset + 2])[0]
+        offset += 2 + client_id_length
+        if flags & 0x04:
+            topic_length = struct.unpack("!H", body[offset:offset + 2])[0]
+            topic = body[offset + 2:offset + 2 + topic_length].decode("utf-8")
+            offset += 2 + topic_length
+            payload_length = struct.unpack("!H", body[offset:offset + 2])[0]
+            payload = body[offset + 2:offset + 2 + payload_length]
+            session.will = (topic, payload, bool(flags & 0x20))
+        self.send(session, CONNACK, 0, b"\x00\x00")
+
+    def handle_publish(self, session: Session, flags: int, body: bytes):
+        topic_length = struct.unpack("!H", body[:2])[0]
+        topic = body[2:2 + topic_length].decode("utf-8")
+        offset = 2 + topic_length
+        qos = (flags >> 1) & 0x03
+        if qos > 0:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            self.send(session, PUBACK if qos == 1 else PUBREC, 0, packet_id)
+        self.route(topic, body[offset:], bool(flags & 0x01))
+
+    def handle_subscribe(self, session: Session, body: bytes):
+        packet_id = body[:2]
+        offset = 2
+        granted = bytearray()
+        topic_filters = []
+        while offset < len(body):
+            length = struct.unpack("!H", body[offset:offset + 2])[0]
+            topic_filters.append(body[offset + 2:offset + 2 + length].decode("utf-8"))
+            offset += 2 + length + 1
+            granted.append(0)
+        session.subscriptions.update(topic_filters)
+        self.send(session, SUBACK, 0, packet_id + bytes(granted))
+        for topic, payload in self.retained.items():
+            if any(topic_matches(topic_filter, topic) for topic_filter in topic_filters):
+                self.send(session, PUBLISH, 0x01, encode_string(topic.encode("utf-8")) + payload)
+
+    def handle_unsubscribe(self, session: Session, body: bytes):
+        offset = 2
+        while offset < len(body):
+            length = struct.unpack("!H", body[offset:offset + 2])[0]
+            session.subscriptions.discard(body[offset + 2:offset + 2 + length].decode("utf-8"))
+            offset += 2 + length
+        self.send(session, UNSUBACK, 0, body[:2])
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = Session(writer)
+        self.sessions.add(session)
+        clean = False
+        try:
+            while True:
+                packet_type, flags, body = await self.read_packet(reader)
+                if packet_type == CONNECT:
+                    self.handle_connect(session, body)
+                elif packet_type == PUBLISH:
+                    self.handle_publish(session, flags, body)
+                elif packet_type == PUBREL:
+                    self.send(session, PUBCOMP, 0, body[:2])
+                elif packet_type == SUBSCRIBE:
+                    self.handle_subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self.handle_unsubscribe(session, body)
+                elif packet_type == PINGREQ:
+                    self.send(session, PINGRESP, 0, b"")
+                elif packet_type == DISCONNECT:
+                    clean = True
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            if not clean and session.will is not None:
+                self.route(*session.will)
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_client, self.address, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        self.started.set()
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        self.loop.run_until_complete(self.serve())
+
+    def start(self) -> int:
+        """Start the broker on a background thread. Returns the port."""
+        thread = threading.Thread(target=self.run, name="q2m-fake-broker", daemon=True)
+        thread.start()
+        self.started.wait()
+        log.info(f"Fake mqtt broker on {self.address}:{self.port}")
+        return self.port
@@ -0,0 +1,9 @@
+import os
+
+
+def write_file_atomic(path: str, data: str):
+    """Write to a temp file first and move it in place, so a crash never leaves a half written file."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
@@ -22,11 +22,70 @@ class Q2mState(BaseModel):
     running: bool = True
 
 
+class InstanceState(Q2mState):
+    # Heartbeat of a bridge instance in a cluster. Unix time, so other hosts can judge its age.
+    heartbeat: float = 0
+    pumps: int = 0
+
+
+class PumpLease(BaseModel):
+    instance_id: str
+    timestamp: float = 0
+
+
+class PollTiming(BaseModel):
+    fetch: float = 0
+    parse: float = 0
+    publish: float = 0
+    total: float = 0
+    timestamp: Optional[datetime] = None
+    last_error: Optional[str] = None
+    last_error_timestamp: Optional[datetime] = None
+
+
+class PumpTiming(BaseModel):
+    # Last poll of every endpoint of the pump
+    endpoints: dict[str, PollTiming] = {}
+    last_error: Optional[str] = None
+    last_error_timestamp: Optional[datetime] = None
+    time_to_first_state: Optional[float] = None
+
+
+class EndpointFreshness(BaseModel):
+    stale: bool = False
+    age: Optional[float] = None
+    last_update: Optional[datetime] = None
+    breaker: Optional[str] = None
+
+
+class PumpFreshness(BaseModel):
+    # Stale if the last poll of any endpoint failed or was skipped. Age of the status.
+    stale: bool = False
+    age: Optional[float] = None
+    last_update: Optional[datetime] = None
+    endpoints: dict[str, EndpointFreshness] = {}
+
+
 class Q2mStatus(BaseModel):
     last_error: Optional[Any] = None
     last_error_timestamp: Optional[datetime] = None
     logging: Optional[str] = None
     state: Q2mState = Q2mState()
+    cycle_time: float = 0
+    cycle_polls: int = 0
+    time_to_first_state: Optional[float] = None
+    breakers: dict[str, str] = {}
+    pumps: int = 0
+
+
+class CommandStats(BaseModel):
+    queue_depth: int = 0
+    completed: int = 0
+    failed: int = 0
+    last_wait: float = 0
+    last_duration: float = 0
+    max_wait: float = 0
+    max_duration: float = 0
 
 
 class DeviceClass(str, Enum):
@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Optional
+
+from files import write_file_atomic
+from qvantum_classes import QvantumBaseModel
+
+log = logging.getLogger(__name__)
+
+
+class InventoryCache:
+    """
+    Disk backed cache for the pump inventories (settings, metrics and alarms).
+
+    The inventories only change with the firmware, so entries are keyed by pump id and
+    firmware version, and are invalidated when the version changes or the entry is older
+    than ttl seconds. A ttl of 0 disables the disk cache, but each inventory is still
+    only fetched once per startup.
+    """
+
+    def __init__(self, path: str, ttl: int):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # {pump_id: {"fw_version": str, "inventories": {name: {"timestamp": float, "data": str}}}}
+        self.entries: dict[str, dict] = {}
+        self.load()
+
+    def load(self):
+        if self.ttl <= 0 or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning(f"Could not read inventory cache {self.path}: {e!r}")
+            self.entries = {}
+
+    def save(self):
+        if self.ttl <= 0:
+            return
+        with self.lock:
+            data = json.dumps(self.entries)
+        try:
+            write_file_atomic(self.path, data)
+        except OSError as e:
+            log.warning(f"Could not write inventory cache {self.path}: {e!r}")
+
+    def get_raw(self, pump_id: str, fw_version: str, name: str, max_age: Optional[float] = None) -> Optional[bytes]:
+        with self.lock:
+            entry = self.entries.get(pump_id)
+            if entry is None or entry.get("fw_version") != fw_version:
+                return None
+            inventory = entry["inventories"].get(name)
+        if inventory is None:
+            return None
+        if max_age is not None and time.time() - inventory["timestamp"] > max_age:
+            return None
+        return inventory["data"].encode("utf-8")
+
+    def set_raw(self, pump_id: str, fw_version: str, name: str, data: bytes):
+        with self.lock:
+            entry = self.entries.get(pump_id)
+            if entry is None or entry.get("fw_version") != fw_version:
+                # New pump or new firmware. Drop everything known about the old version.
+                entry = {"fw_version": fw_version, "inventories": {}}
+                self.entries[pump_id] = entry
+            entry["inventories"][name] = {"timestamp": time.time(), "data": data.decode("utf-8")}
+
+    def get(self, pump_id: str, fw_version: Optional[str], name: str,
+            fetch: Callable[[str], tuple[Optional[QvantumBaseModel], Optional[bytes]]],
+            model: type[QvantumBaseModel]) -> tuple[Optional[QvantumBaseModel], Optional[bytes]]:
+        """
+        Get an inventory from the cache, or fetch it from the api if missing or expired.
+        Returns the parsed inventory and the raw data, in the same way as the api methods.
+        Without a firmware version the cache is not used, the entry of the pump is kept.
+        """
+        if fw_version is None:
+            log.debug(f"Firmware of {pump_id} unknown. Not using the inventory cache.")
+            return fetch(pump_id)
+        # Without disk cache, entries only live in memory for this run and never expire
+        max_age = self.ttl if self.ttl > 0 else None
+        raw = self.get_raw(pump_id, fw_version, name, max_age=max_age)
+        if raw is not None:
+            log.debug(f"Inventory cache hit: {pump_id} {name}")
+            return model.model_validate_json(raw), raw
+
+        log.debug(f"Inventory cache miss: {pump_id} {name}")
+        inventory, raw = fetch(pump_id)
+        if inventory is not None:
+            self.set_raw(pump_id, fw_version, name, raw)
+        return inventory, raw
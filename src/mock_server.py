@@ -0,0 +1,484 @@
+import argparse
+import hashlib
+import json
+import logging
+import math
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Optional
+from urllib.parse import parse_qs, urlencode, urlparse
+
+log = logging.getLogger(__name__)
+
+# The endpoints of heatpump-cloud-http-api.yaml, served below /api
+SETTINGS_INVENTORY = [
+    {"name": "tap_water_capacity_target", "read_only": False, "data_type": "number",
+     "display_name": "Tap water capacity target", "description": "Target capacity of tap water"},
+    {"name": "extra_tap_water", "read_only": False, "data_type": "boolean",
+     "display_name": "Extra tap water", "description": "Temporary extra tap water"},
+    {"name": "tap_water_start", "read_only": False, "data_type": "number",
+     "display_name": "Tap water start", "description": "Start heating tap water below"},
+    {"name": "tap_water_stop", "read_only": False, "data_type": "number",
+     "display_name": "Tap water stop", "description": "Stop heating tap water above"},
+    {"name": "indoor_temperature_target", "read_only": False, "data_type": "number",
+     "display_name": "Indoor temperature target", "description": "Indoor temperature target for thermostat"},
+    {"name": "indoor_temperature_offset", "read_only": False, "data_type": "number",
+     "display_name": "Indoor temperature offset", "description": "Offset of the heating curve"},
+    {"name": "sensor_mode", "read_only": True, "data_type": "string",
+     "display_name": "Sensor mode", "description": "Sensor used for the indoor temperature"},
+    {"name": "vacation_mode", "read_only": False, "data_type": "boolean",
+     "display_name": "Vacation mode", "description": "Lowered temperatures while away"},
+]
+
+DEFAULT_SETTINGS = {
+    "tap_water_capacity_target": 4,
+    "extra_tap_water": "off",
+    "tap_water_start": 50,
+    "tap_water_stop": 60,
+    "indoor_temperature_target": 21,
+    "indoor_temperature_offset": 0,
+    "sensor_mode": "bt2",
+    "vacation_mode": "off",
+}
+
+METRICS_INVENTORY = [
+    {"name": "outdoor_temperature", "unit": "°C", "value_kind": "gauge", "description": "Outdoor temperature"},
+    {"name": "indoor_temperature", "unit": "°C", "value_kind": "gauge", "description": "Indoor temperature"},
+    {"name": "tap_water_capacity", "unit": "", "value_kind": "gauge", "description": "Tap water capacity"},
+    {"name": "tap_water_tank_temperature", "unit": "°C", "value_kind": "gauge",
+     "description": "Tap water tank temperature"},
+    {"name": "heating_flow_temperature", "unit": "°C", "value_kind": "gauge",
+     "description": "Heating flow temperature"},
+    {"name": "heating_flow_temperature_target", "unit": "°C", "value_kind": "gauge",
+     "description": "Heating flow temperature target"},
+    {"name": "tap_water_start", "unit": "°C", "value_kind": "gauge", "description": "Tap water start"},
+    {"name": "tap_water_stop", "unit": "°C", "value_kind": "gauge", "description": "Tap water stop"},
+    {"name": "compressorenergy", "unit": "kWh", "value_kind": "counter", "description": "Compressor energy"},
+    {"name": "additionalenergy", "unit": "kWh", "value_kind": "counter", "description": "Additional energy"},
+]
+
+ALARM_INVENTORY = [
+    {"type": "HEATPUMP", "code": "HP001", "description": "High pressure", "severity": "CRITICAL"},
+    {"type": "HEATPUMP", "code": "HP002", "description": "Low flow", "severity": "SEVERE"},
+    {"type": "WIFI", "code": "WF001", "description": "Weak wifi signal", "severity": "WARNING"},
+    {"type": "CLOUD", "code": "CL001", "description": "Cloud connection lost", "severity": "INFO"},
+]
+
+
+def format_time(value: datetime) -> str:
+    return value.astimezone(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def parse_time(value: Optional[str], default: datetime) -> datetime:
+    if not value:
+        return default
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+class MockPump:
+    """A synthetic pump. Metrics follow smooth daily curves, so they change every poll."""
+
+    def __init__(self, index: int, connected: bool):
+        self.id = str(3010100000000000 + index)
+        self.connected = connected
+        self.phase = random.uniform(0, 2 * math.pi)
+        self.settings: dict[str, Any] = dict(DEFAULT_SETTINGS)
+        self.last_reported = datetime.now(timezone.utc)
+        self.alarms = []
+        if random.random() < 0.2:
+            alarm = random.choice(ALARM_INVENTORY)
+            self.alarms.append({"id": str(uuid.uuid4()),
+                                "device_alarm_id": str(random.randint(1, 9999)),
+                                "type": alarm["type"],
+                                "code": alarm["code"],
+                                "description": alarm["description"],
+                                "severity": alarm["severity"],
+                                "is_active": True,
+                                "is_acknowledged": False,
+                                "triggered_timestamp": format_time(datetime.now(timezone.utc)),
+                                "data": {}})
+
+    def get_metrics(self, at: datetime) -> dict[str, Any]:
+        day = 2 * math.pi * (at.timestamp() % 86400) / 86400 + self.phase
+        hours = (at.timestamp() - 1.7e9) / 3600
+        outdoor = round(5 + 6 * math.sin(day), 1)
+        flow_target = round(35 - outdoor / 2, 1)
+        return {"outdoor_temperature": outdoor,
+                "indoor_temperature": round(self.settings["indoor_temperature_target"] - 0.5 + 0.5 * math.sin(3 * day), 1),
+                "tap_water_capacity": self.settings["tap_water_capacity_target"],
+                "tap_water_tank_temperature": round(55 + 3 * math.sin(5 * day), 1),
+                "heating_flow_temperature": round(flow_target + math.sin(7 * day), 1),
+                "heating_flow_temperature_target": flow_target,
+                "tap_water_start": self.settings["tap_water_start"],
+                "tap_water_stop": self.settings["tap_water_stop"],
+                "compressorenergy": round(hours * 0.8, 2),
+                "additionalenergy": round(hours * 0.05, 2)}
+
+
+class MockCloud:
+    """
+    Local stand-in for the Qvantum cloud, following heatpump-cloud-http-api.yaml.
+
+    Serves a number of synthetic pumps to a single user. Every request is delayed by the
+    configured latency, and a share of the requests fail with a server error, so the poll
+    loop and the command path can be tested offline and under load. Access tokens expire
+    after token_ttl seconds, after which requests get 401 until the token is refreshed.
+    With a rate_limit (requests per second), requests over the limit get 429 with Retry-After.
+    GET responses have an ETag, and a matching If-None-Match gets 304 Not Modified.
+    """
+
+    user_id = "mock-user"
+
+    def __init__(self, pumps: int = 1, latency: float = 0, latency_jitter: float = 0,
+                 error_rate: float = 0, offline_rate: float = 0, token_ttl: int = 3600,
+                 command_latency: float = 0, rate_limit: float = 0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        # Up to one second of requests in a burst
+        self.rate_tokens = rate_limit
+        self.rate_updated = time.monotonic()
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.token_ttl = token_ttl
+        self.command_latency = command_latency
+        self.lock = threading.Lock()
+        self.pumps = {pump.id: pump for pump in
+                      (MockPump(index, random.random() >= offline_rate) for index in range(pumps))}
+        # {access token: expiry}
+        self.access_tokens: dict[str, float] = {}
+        self.requests = 0
+        self.errors = 0
+        self.commands = 0
+        self.throttled = 0
+        self.not_modified = 0
+        self.routes = [
+            ("GET", r"/authorize", self.authorize),
+            ("GET", r"/api/auth/v1/whoami", self.whoami),
+            ("POST", r"/api/auth/v1/oauth2/token", self.token),
+            ("GET", r"/api/inventory/v1/users/(?P<user_id>[^/]+)/devices", self.devices),
+            ("GET", r"/api/inventory/v1/devices/(?P<device_id>[^/]+)", self.device),
+            ("GET", r"/api/inventory/v1/devices/(?P<device_id>[^/]+)/alarms", self.alarm_inventory),
+            ("GET", r"/api/inventory/v1/devices/(?P<device_id>[^/]+)/metrics", self.metrics_inventory),
+            ("GET", r"/api/inventory/v1/devices/(?P<device_id>[^/]+)/settings", self.settings_inventory),
+            ("GET", r"/api/device-info/v1/devices/(?P<device_id>[^/]+)/status", self.status),
+            ("GET", r"/api/device-info/v1/devices/(?P<device_id>[^/]+)/settings", self.settings),
+            ("PATCH", r"/api/device-info/v1/devices/(?P<device_id>[^/]+)/settings", self.patch_settings),
+            ("GET", r"/api/metrics/v1/devices/(?P<device_id>[^/]+)/timelines", self.timelines),
+            ("GET", r"/api/events/v1/devices/(?P<device_id>[^/]+)/alarms", self.alarm_events),
+        ]
+
+    def handle(self, method: str, url: str, headers: dict[str, str], body: bytes) -> tuple[int, Any, dict]:
+        """Handle a request. Returns the status code, the body and extra response headers."""
+        with self.lock:
+            self.requests += 1
+            if self.rate_limit > 0:
+                now = time.monotonic()
+                self.rate_tokens = min(self.rate_limit,
+                                       self.rate_tokens + (now - self.rate_updated) * self.rate_limit)
+                self.rate_updated = now
+                if self.rate_tokens < 1:
+                    self.throttled += 1
+                    return 429, {"message": "Too many requests"}, {"Retry-After": "1"}
+                self.rate_tokens -= 1
+        delay = self.latency + random.uniform(0, self.latency_jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+        path = parsed.path.rstrip("/")
+        for route_method, pattern, handler in self.routes:
+            match = re.fullmatch(pattern, path)
+            if match is None or route_method != method:
+                continue
+            if random.random() < self.error_rate:
+                with self.lock:
+                    self.errors += 1
+                return random.choice([500, 502, 503]), {"message": "Injected error"}, {}
+            if handler not in (self.authorize, self.token) and not self.is_authorized(headers):
+                return 401, {"message": "Unauthorized"}, {}
+            device_id = match.groupdict().get("device_id")
+            if device_id is not None and device_id not in self.pumps:
+                return 404, {"message": f"Device {device_id} not found"}, {}
+            return handler(query=query, body=body, **match.groupdict())
+        return 404, {"message": f"No route for {method} {path}"}, {}
+
+    def is_authorized(self, headers: dict[str, str]) -> bool:
+        auth = headers.get("Authorization", "")
+        token = auth[len("Bearer "):] if auth.startswith("Bearer ") else None
+        with self.lock:
+            expiry = self.access_tokens.get(token)
+        return expiry is not None and expiry > time.time()
+
+    def get_pump(self, device_id: str) -> MockPump:
+        return self.pumps[device_id]
+
+    def authorize(self, query: dict, body: bytes):
+        # Skip the login and go straight back to the app with a code
+        redirect = query.get("redirect_uri", ["http://localhost"])[0]
+        params = urlencode({"state": query.get("state", [""])[0], "code": secrets.token_hex(8)})
+        return 302, {"message": "Redirecting"}, {"Location": f"{redirect}?{params}"}
+
+    def token(self, query: dict, body: bytes):
+        form = parse_qs(body.decode("utf-8"))
+        grant_type = form.get("grant_type", [None])[0]
+        if grant_type == "authorization_code" and not form.get("code"):
+            return 400, {"message": "Missing code"}, {}
+        if grant_type == "refresh_token" and not form.get("refresh_token"):
+            return 400, {"message": "Missing refresh_token"}, {}
+        if grant_type not in ("authorization_code", "refresh_token"):
+            return 400, {"message": f"Unsupported grant_type {grant_type}"}, {}
+        access_token = secrets.token_hex(16)
+        with self.lock:
+            now = time.time()
+            # Forget expired tokens, so the table doesn't grow on long runs
+            self.access_tokens = {token: expiry for token, expiry in self.access_tokens.items()
+                                  if expiry > now}
+            self.access_tokens[access_token] = now + self.token_ttl
+        return 200, {"access_token": access_token,
+                     "token_type": "jwt",
+                     "expires_in": self.token_ttl,
+                     "refresh_token": form.get("refresh_token", [secrets.token_hex(16)])[0]}, {}
+
+    def whoami(self, query: dict, body: bytes):
+        return 200, {"email": "mock@example.com", "isQvantum": False, "uid": self.user_id,
+                     "you": "Mock user"}, {}
+
+    def get_device(self, pump: MockPump) -> dict:
+        return {"id": pump.id, "type": "heatpump", "serial": pump.id, "vendor": "Qvantum", "model": "QE-6"}
+
+    def devices(self, query: dict, body: bytes, user_id: str):
+        if user_id not in ("me", self.user_id):
+            return 403, {"message": "Forbidden"}, {}
+        return 200, {"user_id": self.user_id,
+                     "devices": [self.get_device(pump) for pump in self.pumps.values()]}, {}
+
+    def device(self, query: dict, body: bytes, device_id: str):
+        return 200, self.get_device(self.get_pump(device_id)), {}
+
+    def alarm_inventory(self, query: dict, body: bytes, device_id: str):
+        return 200, {"alarms": ALARM_INVENTORY}, {}
+
+    def metrics_inventory(self, query: dict, body: bytes, device_id: str):
+        return 200, {"metrics": METRICS_INVENTORY}, {}
+
+    def settings_inventory(self, query: dict, body: bytes, device_id: str):
+        return 200, {"settings": SETTINGS_INVENTORY}, {}
+
+    def status(self, query: dict, body: bytes, device_id: str):
+        pump = self.get_pump(device_id)
+        now = datetime.now(timezone.utc)
+        response = {"connectivity": {"connected": pump.connected,
+                                     "timestamp": format_time(pump.last_reported),
+                                     "disconnect_reason": None if pump.connected else "client-disconnect"},
+                    "device_metadata": {"uptime_hours": int((now.timestamp() - 1.7e9) / 3600) % 10000,
+                                        "display_fw_version": "1.4.2",
+                                        "cc_fw_version": "2.1.0",
+                                        "inv_fw_version": "0.9.7"}}
+        metrics = query.get("metrics", [None])[0]
+        if metrics == "now":
+            # No current values from a disconnected pump
+            response["metrics"] = {"time": format_time(now), **pump.get_metrics(now)} \
+                if pump.connected else {"time": None}
+        elif metrics == "last":
+            response["metrics"] = {"time": format_time(pump.last_reported),
+                                   **pump.get_metrics(pump.last_reported)}
+        if pump.connected:
+            pump.last_reported = now
+        return 200, response, {}
+
+    def settings(self, query: dict, body: bytes, device_id: str):
+        pump = self.get_pump(device_id)
+        with self.lock:
+            settings = dict(pump.settings)
+        read_only = {setting["name"] for setting in SETTINGS_INVENTORY if setting["read_only"]}
+        valid_until = pump.last_reported + timedelta(hours=1)
+        return 200, {"meta": {"last_reported": format_time(pump.last_reported),
+                              "validity": "now" if pump.connected else "valid_until",
+                              "valid_until": format_time(valid_until)},
+                     "settings": [{"name": name, "value": value, "read_only": name in read_only}
+                                  for name, value in settings.items()]}, {}
+
+    def patch_settings(self, query: dict, body: bytes, device_id: str):
+        pump = self.get_pump(device_id)
+        try:
+            settings = json.loads(body)["settings"]
+            updates = {setting["name"]: setting["value"] for setting in settings}
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {"message": f"Invalid body: {e!r}"}, {}
+        writable = {setting["name"] for setting in SETTINGS_INVENTORY if not setting["read_only"]}
+        forbidden = [name for name in updates if name not in writable]
+        if forbidden and len(forbidden) == len(updates):
+            return 403, {"meta": {"forbidden": forbidden}, "message": "Forbidden"}, {}
+        if not pump.connected:
+            return 503, {"message": "Failed to reach device"}, {}
+
+        start = time.monotonic()
+        if self.command_latency > 0:
+            time.sleep(self.command_latency)
+        with self.lock:
+            self.commands += 1
+            for name, value in updates.items():
+                if name in writable:
+                    pump.settings[name] = value
+        dispatch = query.get("dispatch", ["false"])[0] == "true"
+        return 202 if dispatch else 200, {"id": str(uuid.uuid4()),
+                                          "status": "TRANSMITTED" if dispatch else "APPLIED",
+                                          "total_latency": round(time.monotonic() - start, 3),
+                                          "meta": {"forbidden": forbidden}}, {}
+
+    def timelines(self, query: dict, body: bytes, device_id: str):
+        pump = self.get_pump(device_id)
+        resolution = query.get("resolution", ["hourly"])[0]
+        if resolution not in ("hourly", "daily"):
+            return 400, "Invalid resolution", {}
+        known = {metric["name"] for metric in METRICS_INVENTORY}
+        names = query.get("metric_names", [",".join(sorted(known))])[0].split(",")
+        unknown = [name for name in names if name not in known]
+        if unknown:
+            return 400, f"Incorrect metric ids \"{','.join(unknown)}\"", {}
+
+        now = datetime.now(timezone.utc)
+        try:
+            start = parse_time(query.get("start", [None])[0], now - timedelta(days=7))
+            end = parse_time(query.get("end", [None])[0], now)
+        except ValueError as e:
+            return 400, f"Invalid range: {e}", {}
+        step = timedelta(days=1) if resolution == "daily" else timedelta(hours=1)
+        # The range is expanded to whole hours or days
+        point = start.replace(minute=0, second=0, microsecond=0)
+        if resolution == "daily":
+            point = point.replace(hour=0)
+        points = []
+        while point <= end and point <= now:
+            values = pump.get_metrics(point)
+            points.append({"time": format_time(point), "hpid": pump.id,
+                           **{name: values[name] for name in names}})
+            point += step
+        return 200, {"metadata": {"start": format_time(start), "end": format_time(end),
+                                  "resolution": resolution},
+                     "metrics": points}, {}
+
+    def alarm_events(self, query: dict, body: bytes, device_id: str):
+        pump = self.get_pump(device_id)
+        limit = min(int(float(query.get("limit", ["10"])[0])), 50)
+        return 200, {"alarms": pump.alarms[:limit]}, {}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately. Don't let them wait on delayed acks.
+    disable_nagle_algorithm = True
+    cloud: MockCloud = None
+
+    def handle_request(self, method: str):
+        length = int(self.headers.get("Content-Length", 0) or 0)
+        body = self.rfile.read(length) if length else b""
+        code, response, headers = self.cloud.handle(method, self.path, dict(self.headers), body)
+        if isinstance(response, str):
+            payload = response.encode("utf-8")
+            content_type = "text/plain; charset=utf-8"
+        else:
+            payload = json.dumps(response).encode("utf-8")
+            content_type = "application/json"
+        if method == "GET" and code == 200:
+            # Conditional requests, as a caching http server would answer them
+            headers = {**headers, "ETag": f'"{hashlib.sha1(payload).hexdigest()[:16]}"'}
+            if self.headers.get("If-None-Match") == headers["ETag"]:
+                with self.cloud.lock:
+                    self.cloud.not_modified += 1
+                code, payload = 304, b""
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+def start_server(cloud: MockCloud, address: str, port: int) -> ThreadingHTTPServer:
+    handler = type("BoundMockHandler", (MockHandler,), {"cloud": cloud})
+    server = ThreadingHTTPServer((address, port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(
+        target=server.serve_forever, name="q2m-mock-cloud", daemon=True)
+    thread.start()
+    log.info(f"Mock Qvantum cloud with {len(cloud.pumps)} pumps on "
+             f"http://{address}:{server.server_address[1]}")
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Local mock of the Qvantum cloud api, for running the bridge offline. "
+                    "Set api_endpoint and auth_server to http://<address>:<port> in config.ini.")
+    parser.add_argument("--address", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--pumps", type=int, default=1,
+                        help="Number of synthetic pumps")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Delay of every request, in seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0,
+                        help="Random extra delay of every request, up to this many seconds")
+    parser.add_argument("--command-latency", type=float, default=0,
+                        help="Extra delay of setting updates, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Share of requests that fail with a server error, 0-1")
+    parser.add_argument("--offline-rate", type=float, default=0,
+                        help="Share of pumps that are disconnected, 0-1")
+    parser.add_argument("--token-ttl", type=int, default=3600,
+                        help="Lifetime of access tokens, in seconds")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="Requests per second before answering 429 Too Many Requests")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="Seed for the random pumps and errors")
+    args = parser.parse_args()
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s - q2m-mock - %(levelname)s - %(message)s'))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.INFO)
+    if args.seed is not None:
+        random.seed(args.seed)
+    cloud = MockCloud(pumps=args.pumps, latency=args.latency, latency_jitter=args.latency_jitter,
+                      error_rate=args.error_rate, offline_rate=args.offline_rate,
+                      token_ttl=args.token_ttl, command_latency=args.command_latency,
+                      rate_limit=args.rate_limit)
+    server = start_server(cloud, args.address, args.port)
+    try:
+        while True:
+            time.sleep(60)
+            log.info(f"{cloud.requests} requests, {cloud.errors} injected errors, "
+                     f"{cloud.commands} commands, {cloud.throttled} throttled, "
+                     f"{cloud.not_modified} not modified")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,60 @@
 import logging
 import sys
+import threading
+import time
+from typing import Callable, Optional
 import paho.mqtt.client as mqtt
 
-from ha_classes import Config, Device, Q2mState
+from ha_classes import CommandStats, Config, Device, Q2mState
+from commands import CommandQueue, WorkerPool
 from config import HomeAssistantConfig, MqttConfig
-from qvantum_api import QvantumApi
+from exporter import PUBLISHED_BYTES, PUBLISHED_MESSAGES, SKIPPED_MESSAGES
+from discovery import DiscoveryManager
+from accounts import Accounts
 
 log = logging.getLogger(__name__)
 
 
 class MqttClient(mqtt.Client):
 
-    def __init__(self, config: MqttConfig, api: QvantumApi, ha: HomeAssistantConfig):
+    def __init__(self, config: MqttConfig, api: Accounts, ha: HomeAssistantConfig,
+                 will_topic: Optional[str] = None):
         super().__init__()
         # TODO: for local mqtt connections this is fine. Add support for TLS
         self.config = config
         self.ha = ha
         # need reference to Api to set values (incoming commands over mqtt)
         self.api = api
-        state_topic = self.get_state_topic(
+        # Incoming messages are handled on a worker pool, never on the network loop
+        self.workers = WorkerPool(
+            self.config.command_workers, self.publish_command_stats)
+        self.commands = CommandQueue(
+            self.api.set_pump_settings, self.config.command_debounce, self.workers)
+        # In a cluster the will goes on the retained topic of the instance instead
+        state_topic = will_topic or self.get_state_topic(
             "q2m", "status", "running")
 
         self.will_set(topic=state_topic,
-                      payload=Q2mState(running=False).model_dump_json())
+                      payload=Q2mState(running=False).model_dump_json(),
+                      retain=will_topic is not None)
         self.username_pw_set(self.config.user, self.config.password)
         self.subs = []
+        # Callbacks for incoming messages on other topics than the setting commands
+        self.handlers: dict[str, Callable[[bytes], None]] = {}
+        # Callbacks for topic filters with wildcards. Get the topic as well.
+        self.topic_handlers: dict[str, Callable[[str, bytes], None]] = {}
+        # Commands for pumps this instance doesn't serve are ignored
+        self.is_served: Callable[[str], bool] = lambda pump_id: True
+        # Called when HA comes online, after the configs are published again
+        self.on_ha_online: Optional[Callable[[], None]] = None
         self.connected = False
+        # Last published payload and timestamp per state topic. Used to skip unchanged states.
+        self.published: dict[str, tuple[object, float]] = {}
+        self.published_lock = threading.Lock()
+        self.discovery = DiscoveryManager(self.ha.discovery_cache_path,
+                                          f"{self.config.server}:{self.config.port}")
+        # HA announces itself when it starts, and when it reconnects to the broker
+        self.add_handler(f"{self.ha.topic_prefix}/status", self.handle_ha_status)
         if self.connect(self.config.server, self.config.port, 60) != 0:
             log.error("Couldn't connect to the mqtt broker")
             sys.exit(1)
@@ -33,38 +62,153 @@ class MqttClient(mqtt.Client):
     def on_connect(self, client, userdata, flags, reason_code):
         log.debug("Connected")
         self.connected = True
+        # States are not retained. Make sure everything is sent again after a reconnect.
+        self.clear_published()
         for topic in self.subs:
             log.debug(f"sub topic {topic}")
             self.subscribe(topic)
         self.publish_state("q2m",  "status", "running",
                            Q2mState().model_dump_json())
 
+    def on_disconnect(self, client, userdata, rc):
+        log.warning(f"Disconnected from the broker: {rc}")
+        self.connected = False
+
     def on_message(self, client, userdata, message):
         log.debug("received message =", str(message.payload.decode("utf-8")))
         log.debug(f"on topic: {message.topic}")
+        handler = self.handlers.get(message.topic)
+        if handler is not None:
+            self.workers.submit(message.topic, handler, message.payload)
+            return
+        for topic_filter, topic_handler in self.topic_handlers.items():
+            if mqtt.topic_matches_sub(topic_filter, message.topic):
+                self.workers.submit(message.topic, topic_handler,
+                                    message.topic, message.payload)
+                return
         parts = message.topic.split("/")
         device_id = parts[2]
         setting = parts[4]
-        self.api.set_pump_setting(
-            device_id, setting, message.payload.decode("utf-8"))
-
-    def publish_msg(self, topic: str, value, retain: bool = False):
-        self.publish(topic, value, qos=0, retain=retain)
+        if not self.is_served(device_id):
+            return
+        # Bursts of commands (e.g. from a slider or an automation) are merged into one request
+        self.commands.put(device_id, setting, message.payload.decode("utf-8"))
+
+    def publish_command_stats(self, stats: CommandStats):
+        self.publish_state("q2m", "status", "commands",
+                           stats.model_dump_json())
+
+    def publish_msg(self, topic: str, value, retain: bool = False) -> bool:
+        info = self.publish(topic, value, qos=0, retain=retain)
+        category = self.get_topic_category(topic)
+        PUBLISHED_MESSAGES.inc(category=category)
+        if value is not None:
+            size = len(value.encode("utf-8")) if isinstance(value, str) else len(value)
+            PUBLISHED_BYTES.inc(size, category=category)
+        return info.rc == mqtt.MQTT_ERR_SUCCESS
+
+    def get_topic_category(self, topic: str) -> str:
+        """Category of the topic, for metrics. E.g. status, settings or discovery."""
+        if topic.startswith(f"{self.ha.topic_prefix}/"):
+            return "discovery"
+        parts = topic.split("/")
+        if len(parts) == 6 and parts[1] == "devices":
+            return parts[3]
+        return "other"
 
     def disconnect(self):
         self.disconnect()
 
     def add_subscribe(self, topic: str):
-        if topic not in self.subs:
-            self.subs.append(topic)
+        if topic in self.subs:
+            return
+        self.subs.append(topic)
+        # The network loop runs while the pumps are configured. on_connect may be done already.
+        if self.connected:
+            self.subscribe(topic)
+
+    def add_handler(self, topic: str, handler: Callable[[bytes], None]):
+        self.handlers[topic] = handler
+        self.add_subscribe(topic)
+
+    def add_topic_handler(self, topic_filter: str, handler: Callable[[str, bytes], None]):
+        self.topic_handlers[topic_filter] = handler
+        self.add_subscribe(topic_filter)
 
     def deploy_config(self, config_topic: str, config: Config):
-        self.publish_msg(config_topic, config.model_dump_json(
-            exclude_none=True), retain=True)
+        payload = config.model_dump_json(exclude_none=True)
+        # The configs are retained. No need to publish them again if unchanged.
+        if not self.discovery.is_changed(config_topic, payload):
+            return
+        if self.publish_msg(config_topic, payload, retain=True):
+            self.discovery.set_published(config_topic, payload)
+
+    def handle_ha_status(self, payload: bytes):
+        """
+        Publish all configs again when HA comes online. The retained configs are gone if
+        the broker was restarted without persistence, and the local hashes can't tell.
+        The states are not retained, so they are all sent again on the next polls too.
+        Otherwise unchanged states, like the connectivity that all entities use for their
+        availability, would be held back for up to republish_interval.
+        """
+        if payload.decode("utf-8") != "online":
+            return
+        deployed = self.discovery.get_deployed()
+        log.info(f"Home Assistant is online. Publishing {len(deployed)} discovery configs.")
+        for config_topic, payload in deployed.items():
+            if self.publish_msg(config_topic, payload, retain=True):
+                self.discovery.set_published(config_topic, payload)
+        self.clear_published()
+        if self.on_ha_online is not None:
+            self.on_ha_online()
+
+    def prune_configs(self, pump_ids: list[str]):
+        """Clear the retained configs of entities that are no longer deployed for the pumps."""
+        for config_topic in self.discovery.get_stale_topics(pump_ids):
+            log.info(f"Removing stale config {config_topic}")
+            if self.clear_topic(config_topic):
+                self.discovery.set_cleared(config_topic)
+        self.discovery.save()
 
     def publish_state(self, pump_id: str, category: str, name: str, value):
-        self.publish_msg(self.get_state_topic(
-            pump_id, category, name), value=value, retain=False)
+        topic = self.get_state_topic(pump_id, category, name)
+        if not self.is_changed(topic, value):
+            SKIPPED_MESSAGES.inc(category=category)
+            return
+        if self.publish_msg(topic, value=value, retain=False):
+            self.set_published(topic, value)
+
+    def is_changed(self, topic: str, value) -> bool:
+        """
+        Check if the value differs from what was last published on the topic. Unchanged
+        values are still republished every republish_interval seconds as a heartbeat.
+        """
+        if not self.config.publish_cache:
+            return True
+        with self.published_lock:
+            last = self.published.get(topic)
+        if last is None:
+            return True
+        last_value, timestamp = last
+        if last_value != value:
+            return True
+        return time.monotonic() - timestamp >= self.config.republish_interval
+
+    def set_published(self, topic: str, value):
+        if not self.config.publish_cache:
+            return
+        with self.published_lock:
+            self.published[topic] = (value, time.monotonic())
+
+    def clear_published(self, pump_id: Optional[str] = None):
+        """Forget what was published, for all topics or only the topics of the pump."""
+        with self.published_lock:
+            if pump_id is None:
+                self.published.clear()
+                return
+            prefix = f"qvantum/devices/{pump_id}/"
+            for topic in [topic for topic in self.published if topic.startswith(prefix)]:
+                del self.published[topic]
 
     def get_state_topic(self, pump_id: str, category: str, name: str) -> str:
         return f"qvantum/devices/{pump_id}/{category}/{name}/value"
@@ -79,5 +223,7 @@ class MqttClient(mqtt.Client):
     def get_value_template(self, value_key) -> str:
         return "{a} value_json.{value_key} {b}".format(a="{{", value_key=value_key, b="}}")
 
-    def clear_topic(self, topic):
-        self.publish_msg(topic, None)
+    def clear_topic(self, topic) -> bool:
+        # An empty retained message removes the retained message on the broker
+        return self.publish_msg(topic, None, retain=True)
+
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from scheduler import Endpoint
+
+log = logging.getLogger(__name__)
+
+
+class AsyncPoller:
+    """Poll engine that fetches all pumps and endpoints concurrently.
+
+    The api layer is blocking (requests), so every call is dispatched to a bounded
+    thread pool. The size of the pool is the concurrency limit, i.e. the max number
+    of requests in flight towards the api at any time.
+
+    Endpoints are polled when the scheduler says they are due. A slow pump does not
+    delay the others, but an endpoint is never polled again while still in flight.
+    """
+
+    def __init__(self, q2m, concurrency: int):
+        self.q2m = q2m
+        self.scheduler = q2m.scheduler
+        self.executor = ThreadPoolExecutor(max_workers=max(1, concurrency),
+                                           thread_name_prefix="q2m-poll")
+        self.in_flight: set[tuple[str, Endpoint]] = set()
+        self.tasks: set[asyncio.Task] = set()
+        # Set from other threads by the scheduler. Waited on in the loop, not in a thread,
+        # so the executor has no thread to join at shutdown.
+        self.wakeup: Optional[asyncio.Event] = None
+
+    async def call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def poll(self, pump_id: str, endpoint: Endpoint):
+        try:
+            if self.q2m.breakers[endpoint].is_open():
+                # Don't take up a thread for a poll that won't be sent
+                self.q2m.skip_endpoint(pump_id, endpoint)
+                return
+            await self.call(self.q2m.poll_endpoint, pump_id, endpoint)
+        except Exception as e:
+            # A failing pump should not affect the others
+            log.error(f"Failed to update {endpoint.value} of {pump_id}: {e!r}")
+        finally:
+            self.in_flight.discard((pump_id, endpoint))
+
+    async def poll_cycle(self, due: list[tuple[str, Endpoint]]):
+        start = time.monotonic()
+        await asyncio.gather(*[self.poll(*key) for key in due])
+        self.q2m.publish_q2m_status(time.monotonic() - start)
+
+    def start_due(self):
+        due = []
+        for key in self.scheduler.get_due():
+            if key in self.in_flight:
+                log.debug(f"Skipping {key[1].value} of {key[0]}. Still in flight.")
+                continue
+            self.in_flight.add(key)
+            due.append(key)
+        if not due:
+            return
+        # The cycles are not awaited. A slow pump should not delay the next cycle.
+        task = asyncio.create_task(self.poll_cycle(due))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def wake(self, loop: asyncio.AbstractEventLoop):
+        try:
+            loop.call_soon_threadsafe(self.wakeup.set)
+        except RuntimeError:
+            # The loop is closed, shutting down
+            pass
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.scheduler.add_listener(lambda: self.wake(loop))
+        # The access token is refreshed in the background by the token manager
+        while True:
+            self.start_due()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.scheduler.get_timeout())
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
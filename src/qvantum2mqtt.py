@@ -1,99 +1,364 @@
 
 
 import argparse
+import asyncio
 import logging
 import sys
+import threading
 import time
 import traceback
-from typing import Optional
+import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Optional
 from mqtt import MqttClient
 from ha_classes import Availability, BinarySensor, Device, DeviceClass, Number, Sensor, Switch
+from backfill import Backfill
+from accounts import Account, Accounts
+from bridge_status import FreshnessTracker, StatusTracker
+from circuit_breaker import CircuitBreaker
+from cluster import ClusterCoordinator, get_instance_topic
 from config import Config, load_config
-from qvantum_api import QvantumApi
-from qvantum_classes import Connectivity, MetaData, MetricsInventory, MetricsInventoryResponse, Setting
+from exporter import POLL_CYCLE_DURATION, POLL_DURATION, start_server
+from inventory_cache import InventoryCache
+from qvantum_api import AuthenticationError, QvantumApi, cast_setting_value, create_session
+from poller import AsyncPoller
+from rate_limit import TokenBucket
+from scheduler import Endpoint, PollScheduler
+from tsdb import MetricsStore, get_request_pump_id
+from qvantum_classes import AlarmEventsResponse, AlarmInventoryResponse, Connectivity, Meta, MetaData, \
+    MetricsInventory, MetricsInventoryResponse, MetricsResponse, Pump, PumpSettingsResponse, PumpStatusResponse, \
+    QvantumBaseModel, Setting, SettingsDocument, SettingsInventoryResponse
 
 log = logging.getLogger(__name__)
 
 
 class Qvantum2Mqtt:
 
+    # Wait time before trying again to list the pumps of an account
+    account_retry_interval = 60
+
     def __init__(self, config: Config):
 
         self.config = config
-        # Init API class
-        self.api = QvantumApi(config.api)
+        # One api per account, all on the same connection pool
+        self.accounts = Accounts()
+        session = create_session(config.api.http_pool_size)
+        rate_limiter = TokenBucket(config.api.rate_limit, config.api.rate_limit_burst)
+        api_configs = config.get_api_configs()
+
+        self.scheduler = PollScheduler({Endpoint.STATUS: config.api.refresh_interval,
+                                        Endpoint.SETTINGS: config.api.settings_interval,
+                                        Endpoint.ALARMS: config.api.alarms_interval,
+                                        Endpoint.METADATA: config.api.metadata_interval},
+                                       offline_factor=config.api.offline_interval_factor,
+                                       jitter=config.api.poll_jitter)
+
+        self.inventory_cache = InventoryCache(config.api.inventory_cache_path,
+                                              config.api.inventory_cache_ttl)
+
+        # In a cluster, the running state and the q2m status are per instance
+        will_topic = None
+        if config.cluster.enabled:
+            instance_id = config.cluster.get_instance_id()
+            will_topic = get_instance_topic(config.cluster, instance_id)
 
         # Init MQTT class
-        self.mqtt = MqttClient(config.mqtt, self.api, config.ha)
-
-        # Authenticate against qvantum
-        self.api.authenticate()
-        self.devices = self.api.get_pumps().devices
-        while self.devices is None:
-            self.devices = self.api.get_pumps().devices
-            time.sleep(2)
+        self.mqtt = MqttClient(config.mqtt, self.accounts, config.ha, will_topic)
+        self.running_topic = will_topic or self.mqtt.get_state_topic(
+            "q2m", "status", "running")
+        self.status_topic = self.mqtt.get_state_topic("q2m", "status", "bridge")
+
+        # Share the pumps with the other instances on the broker
+        self.cluster = None
+        if config.cluster.enabled:
+            self.status_topic = self.mqtt.get_state_topic(
+                "q2m", "status", f"bridge_{instance_id}")
+            self.cluster = ClusterCoordinator(config.cluster, instance_id, self.mqtt,
+                                              self.on_pumps_acquired, self.on_pumps_released)
+            self.mqtt.is_served = self.cluster.is_owned
+
+        # Timings and errors of the polls, published per pump and as a summary of the bridge
+        self.status = StatusTracker()
+
+        # Stop polling endpoints that keep failing, and mark their last known states stale
+        self.breakers = {endpoint: CircuitBreaker(endpoint.value, config.api.breaker_threshold,
+                                                  config.api.breaker_backoff, config.api.breaker_max_backoff)
+                         for endpoint in Endpoint}
+        self.freshness = FreshnessTracker(Endpoint.STATUS.value)
+
+        # Last known settings of each pump, used to publish the expected state after a command
+        self.settings_state: dict[str, dict[str, Setting]] = {}
+        self.settings_meta: dict[str, Meta] = {}
+        self.mqtt.commands.on_sent = self.on_settings_sent
+        self.mqtt.on_ha_online = self.poll_all
+
+        # Local storage of the polled metrics
+        self.store = None
+        if config.tsdb.enabled:
+            self.store = MetricsStore(config.tsdb)
+            self.mqtt.add_handler(config.tsdb.request_topic,
+                                  self.handle_history_request)
+
+        # Started with the poll loop
+        self.backfill: Optional[Backfill] = None
+
+        # Authenticate against qvantum. One account failing doesn't stop the others.
+        for name, api_config in api_configs.items():
+            api = QvantumApi(api_config, session, rate_limiter)
+            try:
+                api.authenticate()
+            except (AuthenticationError, requests.RequestException) as e:
+                log.error(f"Could not log in account {name}: {e}. Skipping it.")
+                continue
+            self.accounts.add(Account(name, api))
+        if not self.accounts.accounts:
+            log.error("None of the accounts could be logged in. Exiting.")
+            sys.exit(1)
+
+    @property
+    def devices(self) -> list[Pump]:
+        """The pumps of all accounts that have been listed so far."""
+        return self.accounts.get_devices()
+
+    def dump(self, model: QvantumBaseModel) -> str | bytes:
+        """Serialize a polled state. Only for models that hold plain json values."""
+        if self.config.mqtt.fast_serialize:
+            return model.dump_json_fast()
+        return model.model_dump_json()
+
+    def publish_settings(self, pump_id: str, pump_settings: Optional[PumpSettingsResponse]):
+        if pump_settings is None:
+            return
+        self.settings_state[pump_id] = {
+            setting.name: setting for setting in pump_settings.settings}
+        self.settings_meta[pump_id] = pump_settings.meta
+        if self.config.mqtt.settings_document:
+            self.publish_settings_document(pump_id, self.settings_state[pump_id])
+            return
+
+        self.mqtt.publish_state(pump_id, "settings", "meta",
+                                self.dump(pump_settings.meta))
+        for setting in pump_settings.settings:
+            self.mqtt.publish_state(pump_id, "settings", setting.name,
+                                    self.dump(setting))
+
+    def on_settings_sent(self, pump_id: str, settings: dict[str, Any], response):
+        """
+        Called after a settings request. If it was accepted, publish the new values right
+        away instead of waiting for the next poll, so HA doesn't show the old value meanwhile.
+        In both cases the settings of the pump are refreshed soon, to get the actual state.
+        """
+        if response is not None:
+            known = self.settings_state.get(pump_id, {})
+            expected = {}
+            for name, value in settings.items():
+                setting = known.get(name, Setting(name=name, read_only=False))
+                expected[name] = setting.model_copy(
+                    update={"value": cast_setting_value(value)})
+            if self.config.mqtt.settings_document:
+                self.publish_settings_document(pump_id, {**known, **expected})
+            else:
+                for name, setting in expected.items():
+                    self.mqtt.publish_state(pump_id, "settings", name,
+                                            self.dump(setting))
+        self.scheduler.trigger(pump_id, Endpoint.SETTINGS,
+                               delay=self.config.api.command_refresh_delay)
+
+    def publish_settings_document(self, pump_id: str, settings: dict[str, Setting]):
+        document = SettingsDocument(meta=self.settings_meta.get(pump_id), settings=settings)
+        self.mqtt.publish_state(pump_id, "settings", "all",
+                                self.dump(document))
+
+    def publish_status(self, pump_id: str, pump_status: Optional[PumpStatusResponse], raw: bytes):
+        if pump_status is None:
+            return
 
-    def refresh_token(self):
-        log.info("Refresh token")
-        self.api.refresh_access_token()
+        self.mqtt.publish_state(
+            pump_id, "status", "raw_data", raw)
+        # pump_status.metrics may be empty. Timestamp is None and hpid is the only thing set.
+        if pump_status.connectivity is not None and pump_status.metrics is not None \
+                and pump_status.metrics.time is not None:
+            self.mqtt.publish_state(pump_id, "status", "connectivity",
+                                    self.dump(pump_status.connectivity))
+
+        if pump_status.metrics is not None:
+            self.mqtt.publish_state(pump_id, "status", "metrics",
+                                    self.dump(pump_status.metrics))
+            if self.store is not None:
+                self.store.add(pump_id, pump_status.metrics)
+
+    def publish_metadata(self, pump_id: str, pump_status: Optional[PumpStatusResponse]):
+        if pump_status is None or pump_status.device_data is None:
+            return
+        self.mqtt.publish_state(pump_id, "status", "metadata",
+                                self.dump(pump_status.device_data))
+
+    def publish_alarms(self, pump_id: str, alarms: Optional[AlarmEventsResponse]):
+        if alarms is None:
+            return
+        self.mqtt.publish_state(pump_id, "status", "alarms",
+                                alarms.model_dump_json())
+
+    def publish_history(self, pump_id: str, resolution: str, metrics: MetricsResponse):
+        self.mqtt.publish_state(pump_id, "history", resolution,
+                                metrics.model_dump_json())
+        if self.store is not None:
+            self.store.add_timeline(pump_id, resolution, metrics)
+
+    def handle_history_request(self, payload: bytes):
+        # All instances of a cluster get the request. Only the one polling the pump has its history.
+        if self.cluster is not None:
+            pump_id = get_request_pump_id(payload)
+            if pump_id is None or not self.cluster.is_owned(pump_id):
+                return
+        topic, response = self.store.handle_request(payload)
+        self.mqtt.publish_msg(topic, response)
+
+    def poll_endpoint(self, pump_id: str, endpoint: Endpoint):
+        if not self.breakers[endpoint].allow():
+            self.skip_endpoint(pump_id, endpoint)
+            return
+        start = time.monotonic()
+        try:
+            self.update_endpoint(pump_id, endpoint)
+        finally:
+            POLL_DURATION.observe(time.monotonic() - start,
+                                  endpoint=endpoint.value)
+
+    def update_endpoint(self, pump_id: str, endpoint: Endpoint):
+        api = self.accounts.get_api(pump_id)
+        api.pop_http_time()
+        start = time.monotonic()
+        try:
+            data = self.fetch_endpoint(api, pump_id, endpoint)
+        except Exception as e:
+            http_time = api.pop_http_time()
+            self.status.record(pump_id, endpoint.value, http_time,
+                               time.monotonic() - start - http_time, 0, repr(e))
+            self.breakers[endpoint].record_failure()
+            self.update_freshness(pump_id, endpoint, False)
+            raise
+        fetched = time.monotonic()
+        # Time not spent waiting for the api is spent decoding the response
+        http_time = api.pop_http_time()
+        parse_time = max(fetched - start - http_time, 0)
+        if data is None:
+            self.status.record(pump_id, endpoint.value, http_time, parse_time, 0,
+                               "No data returned from the api")
+            self.breakers[endpoint].record_failure()
+            self.update_freshness(pump_id, endpoint, False)
+            return
+
+        self.breakers[endpoint].record_success()
+        self.publish_endpoint(pump_id, endpoint, data)
+        self.status.record(pump_id, endpoint.value, http_time, parse_time,
+                           time.monotonic() - fetched)
+        self.update_freshness(pump_id, endpoint, True)
+
+    def poll_all(self):
+        """Poll every endpoint of every pump now, e.g. to give a restarted HA all states."""
+        for pump_id in self.scheduler.get_pumps():
+            for endpoint in Endpoint:
+                self.scheduler.trigger(pump_id, endpoint)
+
+    def skip_endpoint(self, pump_id: str, endpoint: Endpoint):
+        """The breaker of the endpoint is open. Keep the last known state, but mark it stale."""
+        self.update_freshness(pump_id, endpoint, False)
+
+    def get_breaker_states(self) -> dict[str, str]:
+        return {endpoint.value: breaker.state.value for endpoint, breaker in self.breakers.items()}
+
+    def update_freshness(self, pump_id: str, endpoint: Endpoint, fresh: bool):
+        """Publish the freshness of the pump when it turns stale or fresh, and the age while stale."""
+        changed = self.freshness.set(pump_id, endpoint.value, fresh)
+        if fresh and not changed:
+            return
+        freshness = self.freshness.get(pump_id, self.get_breaker_states())
+        # Retained, so HA knows the states are stale even after a restart
+        self.mqtt.publish_msg(self.mqtt.get_state_topic(pump_id, "status", "freshness"),
+                              freshness.model_dump_json(), retain=True)
+
+    def fetch_endpoint(self, api: QvantumApi, pump_id: str, endpoint: Endpoint) -> Any:
+        """Fetch and decode the data of the endpoint. None if the request failed."""
+        match endpoint:
+            case Endpoint.STATUS:
+                pump_status, raw = api.get_pump_status(pump_id)
+                return (pump_status, raw) if pump_status is not None else None
+
+            case Endpoint.SETTINGS:
+                return api.get_pump_settings(pump_id)
+
+            case Endpoint.METADATA:
+                # Metadata is part of the status, but is not needed as often as the metrics
+                pump_status, _ = api.get_pump_status(pump_id, metrics=None)
+                return pump_status
+
+            case Endpoint.ALARMS:
+                return api.get_pump_alarm_events(pump_id)
+
+    def publish_endpoint(self, pump_id: str, endpoint: Endpoint, data: Any):
+        match endpoint:
+            case Endpoint.STATUS:
+                pump_status, raw = data
+                if pump_status.connectivity is not None:
+                    self.scheduler.set_connected(
+                        pump_id, pump_status.connectivity.connected)
+                self.publish_status(pump_id, pump_status, raw)
+
+            case Endpoint.SETTINGS:
+                self.publish_settings(pump_id, data)
+
+            case Endpoint.METADATA:
+                self.publish_metadata(pump_id, data)
+
+            case Endpoint.ALARMS:
+                self.publish_alarms(pump_id, data)
+
+    def publish_q2m_status(self, cycle_time: float):
+        POLL_CYCLE_DURATION.observe(cycle_time)
+        # Retained, so the last known status is shown even after a restart of HA
+        for pump_id, timing in self.status.pop_changed().items():
+            self.mqtt.publish_msg(self.mqtt.get_state_topic(pump_id, "status", "q2m"),
+                                  timing.model_dump_json(), retain=True)
+        status = self.status.end_cycle(cycle_time, self.config.api.refresh_interval)
+        if status is None:
+            return
+        status.breakers = self.get_breaker_states()
+        self.mqtt.publish_msg(self.status_topic,
+                              status.model_dump_json(), retain=True)
 
     def update_states(self):
-        count = 0
+        if self.store is not None:
+            self.store.start()
+
+        if self.config.backfill.enabled:
+            self.backfill = Backfill(self.config.backfill, self.accounts, self.publish_history)
+            self.backfill.start(lambda: [pump.id for pump in self.devices
+                                         if self.cluster is None or self.cluster.is_owned(pump.id)])
+
+        if self.config.api.poll_engine == "async":
+            log.info(
+                f"Using async poll engine with concurrency {self.config.api.poll_concurrency}.")
+            asyncio.run(AsyncPoller(
+                self, self.config.api.poll_concurrency).run())
+            return
+
+        # The access token is refreshed in the background by the token manager
         while True:
-            try:
-                log.info("Updating states on all devices.")
-                count += 1
-                # use refresh token to get new access token
-                for pump in self.devices:
-                    pump_settings = self.api.get_pump_settings(pump.id)
-                    if pump_settings is None:
-                        continue
-                    self.mqtt.publish_state(pump.id, "settings", "meta",
-                                            pump_settings.meta.model_dump_json())
-
-                    for setting in pump_settings.settings:
-                        self.mqtt.publish_state(pump.id, "settings", setting.name,
-                                                setting.model_dump_json())
-
-                    pump_status, raw = self.api.get_pump_status(pump.id)
-                    if pump_status is None:
-                        continue
-
-                    self.mqtt.publish_state(
-                        pump.id, "status", "raw_data", str(raw))
-                    # pump_status.metrics may be empty. Timestamp is None and hpid is the only thing set.
-                    if pump_status.connectivity is not None and pump_status.metrics.time is not None:
-                        self.mqtt.publish_state(pump.id, "status", "connectivity",
-                                                pump_status.connectivity.model_dump_json())
-
-                    if pump_status.metrics is not None:
-                        self.mqtt.publish_state(pump.id, "status", "metrics",
-                                                pump_status.metrics.model_dump_json())
-
-                    if pump_status.device_data is not None:
-                        self.mqtt.publish_state(pump.id, "status", "metadata",
-                                                pump_status.device_data.model_dump_json())
-
-                    # This endpoint doesn't work propwerly. Static data and a lot missing... Skip for now
-                    # data = self.api.get_pump_metric(
-                    #     pump.id, ["compressorenergy", "indoor_temperature", "tap_water_capacity", "additionalenergy"])
-                    # log.info(data.json())
-            except Exception as e:
-                log.exception("An exception occured")
-
-            finally:
-                log.info("Sleeping for 10 seconds.")
-                # fetch every 10 seconds
-                time.sleep(self.config.api.refresh_interval)
-                if count % 10 == 0:
-                    self.refresh_token()
-                    count = 0
-
-    def configure_metrics(self, pump_id: str, device: Device, availability: Availability):
-        metrics_inventory, raw = self.api.get_pump_metrics_inventory(pump_id)
-        self.mqtt.publish_state(
-            pump_id, "inventory", "metrics", str(raw))
-
+            due = self.scheduler.get_due()
+            start = time.monotonic()
+            for pump_id, endpoint in due:
+                try:
+                    self.poll_endpoint(pump_id, endpoint)
+                except Exception:
+                    log.exception(
+                        f"Failed to update {endpoint.value} of {pump_id}")
+            if due:
+                self.publish_q2m_status(time.monotonic() - start)
+            self.scheduler.wait()
+
+    def configure_metrics(self, pump_id: str, device: Device, availability: Availability,
+                          metrics_inventory: MetricsInventoryResponse):
         con_state_topic = self.mqtt.get_state_topic(
             pump_id, "status", "connectivity")
         con_config_topic = self.mqtt.get_config_topic(
@@ -115,6 +380,9 @@ class Qvantum2Mqtt:
         self.mqtt.deploy_config(con_config_topic, con_config)
 
         state_topic = self.mqtt.get_state_topic(pump_id, "status", "metrics")
+        # Every metric shows if its value is stale, and how old it is
+        freshness_topic = self.mqtt.get_state_topic(pump_id, "status", "freshness")
+        freshness_template = "{{ {'stale': value_json.stale, 'age': value_json.age} | tojson }}"
         for metric in metrics_inventory.metrics:
             config_topic = self.mqtt.get_config_topic(
                 pump_id, metric.name, "sensor")
@@ -126,16 +394,16 @@ class Qvantum2Mqtt:
                             unique_id=f"qvantum_{pump_id}_{metric.name}",
                             state_topic=state_topic,
                             unit_of_measurement=metric.unit,
-                            value_template=value_template)
+                            value_template=value_template,
+                            json_attributes_topic=freshness_topic,
+                            json_attributes_template=freshness_template)
             self.mqtt.deploy_config(config_topic, config)
 
-    def configure_settings(self, pump_id: str, device: Device, availability: Availability):
+    def configure_settings(self, pump_id: str, device: Device, availability: Availability,
+                           settings_inventory: SettingsInventoryResponse,
+                           metrics_inventory: MetricsInventoryResponse):
         # Listen to set topic
         self.mqtt.add_subscribe(f"qvantum/devices/+/settings/+/set")
-        settings_inventory, raw = self.api.get_pump_settings_inventory(pump_id)
-
-        self.mqtt.publish_state(pump_id, "settings", "raw_data", str(raw))
-        metrics_inventory, _ = self.api.get_pump_metrics_inventory(pump_id)
 
         for setting in settings_inventory.settings:
             unit = ""
@@ -143,10 +411,19 @@ class Qvantum2Mqtt:
             if metric is not None:
                 unit = metric.unit
 
-            state_topic = self.mqtt.get_state_topic(
-                pump_id, "settings", setting.name)
-            value_template = self.mqtt.get_value_template(
-                Setting.get_value_field_name())
+            if self.config.mqtt.settings_document:
+                # All settings are in one document, keyed on setting name
+                state_topic = self.mqtt.get_state_topic(
+                    pump_id, "settings", "all")
+                value_template = self.mqtt.get_value_template(
+                    f"settings['{setting.name}'].{Setting.get_value_field_name()}")
+                attributes_template = f"{{{{ value_json.settings['{setting.name}'] | tojson }}}}"
+            else:
+                state_topic = self.mqtt.get_state_topic(
+                    pump_id, "settings", setting.name)
+                value_template = self.mqtt.get_value_template(
+                    Setting.get_value_field_name())
+                attributes_template = Setting.get_attributes_template()
 
             # old_config_topic = self.mqtt.get_config_topic(
             #     pump_id, setting.name, "sensor")
@@ -167,7 +444,7 @@ class Qvantum2Mqtt:
                                 state_topic=state_topic,
                                 unit_of_measurement=unit,
                                 json_attributes_topic=state_topic,
-                                json_attributes_template=Setting.get_attributes_template(),
+                                json_attributes_template=attributes_template,
                                 value_template=value_template)
                 self.mqtt.deploy_config(config_topic, config)
 
@@ -189,7 +466,7 @@ class Qvantum2Mqtt:
                                     command_topic=command_topic,
                                     unit_of_measurement=unit,
                                     json_attributes_topic=state_topic,
-                                    json_attributes_template=Setting.get_attributes_template(),
+                                    json_attributes_template=attributes_template,
                                     value_template=value_template
                                     )
                     self.mqtt.deploy_config(config_topic, config)
@@ -208,7 +485,7 @@ class Qvantum2Mqtt:
                                               payload_off="off",
                                               unit_of_measurement=unit,
                                               json_attributes_topic=state_topic,
-                                              json_attributes_template=Setting.get_attributes_template(),
+                                              json_attributes_template=attributes_template,
                                               value_template=value_template
                                               )
                         self.mqtt.deploy_config(config_topic, config)
@@ -227,7 +504,7 @@ class Qvantum2Mqtt:
                                         payload_off="off",
                                         unit_of_measurement=unit,
                                         json_attributes_topic=state_topic,
-                                        json_attributes_template=Setting.get_attributes_template(),
+                                        json_attributes_template=attributes_template,
                                         value_template=value_template,
                                         command_topic=command_topic,
                                         )
@@ -244,7 +521,7 @@ class Qvantum2Mqtt:
                                     state_topic=state_topic,
                                     unit_of_measurement=unit,
                                     json_attributes_topic=state_topic,
-                                    json_attributes_template=Setting.get_attributes_template(),
+                                    json_attributes_template=attributes_template,
                                     value_template=value_template)
                     self.mqtt.deploy_config(config_topic, config)
 
@@ -266,14 +543,15 @@ class Qvantum2Mqtt:
                             )
             self.mqtt.deploy_config(config_topic, config)
 
-    def configure_alarms(self, pump_id: str, device: Device, availability: Availability):
+    def configure_alarms(self, pump_id: str, device: Device, availability: Availability,
+                         alarm_inventory: AlarmInventoryResponse):
         # The API does not care about the query category.
         # TODO: rellay have a sensor for each alarm? Gonna be a lot of sensors...
         # Maybe just one sensor "Alarm", with an array of active alarms in the attribute?
         # Not sure how alarm inventory helps. Each alarm already have a description
         # and the current alarm is not mentioned in the inventory...
-        alarms = self.api.get_pump_alarm_inventory(pump_id)
-        # log.info(alarms.json())
+        # log.info(alarm_inventory.json())
+        pass
 
     def configure_q2m_state_sensors(self, pump_id: str, device: Device):
         """Sensors to monitor the state of this process. Such as in case failed calls or lost connection with
@@ -283,8 +561,7 @@ class Qvantum2Mqtt:
         # All devices will listen to the same state topic, but we configure a sensor for each device, so that
         # we get a nice view on the device page for each pump.
         name = "q2m_running_state"
-        state_topic = self.mqtt.get_state_topic(
-            "q2m", "status", "running")
+        state_topic = self.running_topic
         config_topic = self.mqtt.get_config_topic(
             pump_id, name, "binary_sensor")
 
@@ -300,62 +577,254 @@ class Qvantum2Mqtt:
                               )
         self.mqtt.deploy_config(config_topic, config)
 
-        # TODO: Sensor for errors, such as failed requests and parsing.
-        # config = Sensor(device=device,
-        #                 name=setting.display_name,
-        #                 object_id=f"{pump_id}_{setting.name}",
-        #                 unique_id=f"qvantum_{pump_id}_{setting.name}",
-        #                 state_topic=state_topic,
-        #                 json_attributes_topic=state_topic,
-        #                 json_attributes_template=Setting.get_attributes_template(),
-        #                 value_template=value_template)
+        # On when the cloud can't be reached and the states of the pump are the last known ones.
+        # Unlike connectivity, which is what the cloud says about the pump.
+        name = "q2m_stale"
+        freshness_topic = self.mqtt.get_state_topic(pump_id, "status", "freshness")
+        config = BinarySensor(device=device,
+                              name=name,
+                              object_id=f"{pump_id}_{name}",
+                              unique_id=f"qvantum_{pump_id}_{name}",
+                              state_topic=freshness_topic,
+                              device_class=DeviceClass.PROBLEM,
+                              entity_category="diagnostic",
+                              payload_on="True",
+                              payload_off="False",
+                              value_template=self.mqtt.get_value_template("stale"),
+                              json_attributes_topic=freshness_topic)
+        self.mqtt.deploy_config(
+            self.mqtt.get_config_topic(pump_id, name, "binary_sensor"), config)
+
+        # Sensors for the poll timings and errors of the pump
+        timing_topic = self.mqtt.get_state_topic(pump_id, "status", "q2m")
+
+        name = "q2m_last_error"
+        config = Sensor(device=device,
+                        name=name,
+                        object_id=f"{pump_id}_{name}",
+                        unique_id=f"qvantum_{pump_id}_{name}",
+                        state_topic=timing_topic,
+                        entity_category="diagnostic",
+                        value_template="{{ value_json.last_error }}",
+                        json_attributes_topic=timing_topic)
+        self.mqtt.deploy_config(
+            self.mqtt.get_config_topic(pump_id, name, "sensor"), config)
+
+        # The poll time of the status, the other endpoints are in the attributes
+        name = "q2m_poll_time"
+        status_key = f"value_json.endpoints['{Endpoint.STATUS.value}']"
+        config = Sensor(device=device,
+                        name=name,
+                        object_id=f"{pump_id}_{name}",
+                        unique_id=f"qvantum_{pump_id}_{name}",
+                        state_topic=timing_topic,
+                        entity_category="diagnostic",
+                        unit_of_measurement="s",
+                        value_template=f"{{{{ {status_key}.total | round(3) if {status_key} is defined else None }}}}",
+                        json_attributes_topic=timing_topic,
+                        json_attributes_template="{{ value_json.endpoints | tojson }}")
+        self.mqtt.deploy_config(
+            self.mqtt.get_config_topic(pump_id, name, "sensor"), config)
+
+        # From the bridge summary
+        status_topic = self.status_topic
+        name = "q2m_cycle_time"
+        config = Sensor(device=device,
+                        name=name,
+                        object_id=f"{pump_id}_{name}",
+                        unique_id=f"qvantum_{pump_id}_{name}",
+                        state_topic=status_topic,
+                        entity_category="diagnostic",
+                        unit_of_measurement="s",
+                        value_template="{{ value_json.cycle_time | round(3) }}")
+        self.mqtt.deploy_config(
+            self.mqtt.get_config_topic(pump_id, name, "sensor"), config)
+
+    def configure_device(self, api: QvantumApi, pump: Pump, inventory_executor: ThreadPoolExecutor) -> bool:
+        """
+        Deploy the discovery configs of the pump. Returns True if the full inventory was
+        available, so old entities of the pump can be pruned.
+        """
+        # res = api.get_pump_alarm_events(pump.id)
+        # log.info(res)
+
+        # Common HA device for this pump
+        identifiers = [pump.id]
+        name = "Qvantum Värmepump"
+        device = Device(identifiers=identifiers, name=name,
+                        manufacturer=pump.vendor, serial_number=pump.serial, model=pump.model)
+
+        # Get the metadata for the pump
+        pump_status, _ = api.get_pump_status(pump.id)
+        # if there is data to be set, do so
+        # Unknown if the status call failed
+        fw_version = None
+        if pump_status is not None and pump_status.device_data is not None:
+            meta_data: MetaData = pump_status.device_data
+            device.sw_version = meta_data.display_fw_version
+            # Use hw version as placeholder
+            device.hw_version = meta_data.cc_fw_version
+            # meta_data.inv_fw_version is always 0
+            fw_version = f"{meta_data.display_fw_version}/{meta_data.cc_fw_version}"
+
+        # define the availability topic for all sensors
+        availability_topic = self.mqtt.get_state_topic(
+            pump.id, "status", "connectivity")
+        availability = Availability(topic=availability_topic,
+                                    value_template=self.mqtt.get_value_template(
+                                        "connected"),
+                                    payload_available="True",
+                                    payload_not_available="False",
+                                    )
+
+        # Inventories only change with the firmware. Use the cache if possible.
+        # The inventories are independent, so they are fetched at the same time.
+        settings_future = inventory_executor.submit(
+            self.inventory_cache.get, pump.id, fw_version, "settings",
+            api.get_pump_settings_inventory, SettingsInventoryResponse)
+        metrics_future = inventory_executor.submit(
+            self.inventory_cache.get, pump.id, fw_version, "metrics",
+            api.get_pump_metrics_inventory, MetricsInventoryResponse)
+        alarm_future = inventory_executor.submit(
+            self.inventory_cache.get, pump.id, fw_version, "alarms",
+            api.get_pump_alarm_inventory, AlarmInventoryResponse)
+        settings_inventory, settings_raw = settings_future.result()
+        metrics_inventory, metrics_raw = metrics_future.result()
+        alarm_inventory, _ = alarm_future.result()
+
+        if settings_inventory is not None and metrics_inventory is not None:
+            self.mqtt.publish_state(
+                pump.id, "settings", "raw_data", settings_raw)
+            self.configure_settings(
+                pump.id, device, availability, settings_inventory, metrics_inventory)
+        else:
+            log.warning(
+                f"Missing settings or metrics inventory for {pump.id}. Settings not configured.")
+
+        if metrics_inventory is not None:
+            self.mqtt.publish_state(
+                pump.id, "inventory", "metrics", metrics_raw)
+            self.configure_metrics(
+                pump.id, device, availability, metrics_inventory)
+
+        if alarm_inventory is not None:
+            self.configure_alarms(
+                pump.id, device, availability, alarm_inventory)
+        self.configure_device_meta_data(pump.id, device, availability)
+        self.configure_q2m_state_sensors(pump.id, device)
+
+        # Only remove old entities if the full inventory was available, otherwise
+        # entities might be removed just because a request failed
+        return settings_inventory is not None and metrics_inventory is not None
 
     def configure_devices(self):
-        self.refresh_token()
-        for pump in self.devices:
-
-            # res = self.api.get_pump_alarm_events(pump.id)
-            # log.info(res)
-
-            # Common HA device for this pump
-            identifiers = [pump.id]
-            name = "Qvantum Värmepump"
-            device = Device(identifiers=identifiers, name=name,
-                            manufacturer=pump.vendor, serial_number=pump.serial, model=pump.model)
-
-            # Get the metadata for the pump
-            pump_status, _ = self.api.get_pump_status(pump.id)
-            # if there is data to be set, do so
-            if pump_status.device_data is not None:
-                meta_data: MetaData = pump_status.device_data
-                device.sw_version = meta_data.display_fw_version
-                # Use hw version as placeholder
-                device.hw_version = meta_data.cc_fw_version
-                # meta_data.inv_fw_version is always 0
-
-            # define the availability topic for all sensors
-            availability_topic = self.mqtt.get_state_topic(
-                pump.id, "status", "connectivity")
-            availability = Availability(topic=availability_topic,
-                                        value_template=self.mqtt.get_value_template(
-                                            "connected"),
-                                        payload_available="True",
-                                        payload_not_available="False",
-                                        )
-            self.configure_settings(pump.id, device, availability)
-            self.configure_metrics(pump.id, device, availability)
-            self.configure_alarms(pump.id, device, availability)
-            self.configure_device_meta_data(pump.id, device, availability)
-            self.configure_q2m_state_sensors(pump.id, device)
+        """Configure the pumps of all accounts, one account at a time."""
+        for account in self.accounts.accounts:
+            try:
+                self.configure_account(account)
+            except Exception:
+                log.exception(f"Failed to configure account {account.name}")
+
+    def configure_account(self, account: Account):
+        """
+        List the pumps of the account and configure them in parallel. Each pump is added to
+        the poll scheduler as soon as it is configured, so the first states don't wait for
+        the whole account. If the pumps can't be listed, it is tried again later.
+        """
+        pumps = account.api.get_pumps()
+        if pumps is None or pumps.devices is None:
+            log.warning(f"Could not list the pumps of account {account.name}. "
+                        f"Trying again in {self.account_retry_interval}s.")
+            timer = threading.Timer(self.account_retry_interval, self.configure_account, (account,))
+            timer.daemon = True
+            timer.start()
+            return
+        self.accounts.set_devices(account, pumps.devices)
+        self.check_request_budget()
+        if self.cluster is not None:
+            # Only the pumps given to this instance are configured and polled
+            self.cluster.add_pumps([pump.id for pump in pumps.devices])
+            return
+        self.configure_pumps(pumps.devices)
+
+    def check_request_budget(self):
+        """Warn if polling all pumps at the configured intervals needs more requests than the budget."""
+        if self.config.api.rate_limit <= 0:
+            return
+        pumps = len(self.devices)
+        needed = pumps * sum(1 / interval for interval in self.scheduler.intervals.values() if interval > 0)
+        if needed > self.config.api.rate_limit:
+            log.warning(f"Polling {pumps} pumps needs {needed:.1f} requests/s, but rate_limit is "
+                        f"{self.config.api.rate_limit}/s. Polls will be late or skipped. Increase the "
+                        f"poll intervals by {needed / self.config.api.rate_limit:.1f} times to stay in budget.")
+
+    def configure_pumps(self, pumps: list[Pump]):
+        """
+        Configure the pumps in parallel. Each pump is added to the poll scheduler as soon as
+        it is configured, so the first states don't wait for the other pumps.
+        """
+        start = time.monotonic()
+        concurrency = self.config.api.configure_concurrency
+        complete = []
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="q2m-inventory") as inventory_executor, \
+                ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="q2m-configure") as executor:
+            futures = {executor.submit(self.configure_device, self.accounts.get_api(pump.id), pump,
+                                       inventory_executor): pump
+                       for pump in pumps}
+            for future in as_completed(futures):
+                pump = futures[future]
+                try:
+                    if future.result():
+                        complete.append(pump.id)
+                except Exception:
+                    log.exception(f"Failed to configure {pump.id}")
+                # Poll the pump even if not all entities could be configured
+                self.scheduler.add_pump(pump.id)
+
+        # The stores are written once, instead of once per pump
+        self.inventory_cache.save()
+        self.mqtt.prune_configs(complete)
+        log.info(
+            f"Configured {len(pumps)} pumps in {time.monotonic() - start:.1f}s")
+        # The pumps are configured in the background. Don't wait for the next backfill round.
+        if self.backfill is not None:
+            self.backfill.trigger()
+
+    def on_pumps_acquired(self, pump_ids: list[str]):
+        pump_ids = set(pump_ids)
+        pumps = [pump for pump in self.devices if pump.id in pump_ids]
+        for pump in pumps:
+            # Another instance published the states meanwhile
+            self.mqtt.clear_published(pump.id)
+        # And its configs, which point at its own running and status topics
+        self.mqtt.discovery.forget(list(pump_ids))
+        self.configure_pumps(pumps)
+
+    def on_pumps_released(self, pump_ids: list[str]):
+        for pump_id in pump_ids:
+            self.scheduler.remove_pump(pump_id)
+            self.status.remove(pump_id)
+            self.freshness.remove(pump_id)
+        # Not ours to publish again when HA comes online
+        self.mqtt.discovery.forget(pump_ids)
+
+    def run(self):
+        """Configure the pumps in the background, and poll every pump as soon as it is configured."""
+        self.mqtt.loop_start()
+        if self.cluster is not None:
+            self.cluster.start()
+        threading.Thread(target=self.configure_devices,
+                         name="q2m-configure", daemon=True).start()
+        self.update_states()
 
 
 def main(config_path: str = "config.ini"):
     log.info("Starting qvantum2mqtt...")
     config = load_config(config_path)
+    if config.metrics.enabled:
+        start_server(config.metrics.address, config.metrics.port)
     q2m = Qvantum2Mqtt(config)
-    q2m.configure_devices()
-    q2m.mqtt.loop_start()
-    q2m.update_states()
+    q2m.run()
 
 
 if __name__ == "__main__":
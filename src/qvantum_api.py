@@ -1,8 +1,9 @@
 
 
+from datetime import datetime
 import json
 import logging
-from typing import Any
+from typing import Any, Optional
 import requests
 from config import QvantumApiConfig
 from qvantum_classes import *
@@ -11,15 +12,25 @@ from io import BytesIO
 import json
 import os
 import socket
-import sys
-from urllib.parse import parse_qs, urlparse
+import threading
+import time
+from urllib.parse import parse_qs, quote, urlparse
 import webbrowser
 
 import requests
+from requests.adapters import HTTPAdapter
+from exporter import API_REQUEST_DURATION, API_RESPONSES, RATE_LIMIT_WAIT
+from files import write_file_atomic
 from qvantum_classes import Token, TokenUser
+from response_cache import ResponseCache
+from rate_limit import Priority, TokenBucket, parse_retry_after
+from token_manager import TokenManager
 
 log = logging.getLogger(__name__)
 
+# Timezone of the metric timelines. Hourly and daily values are whole hours and days in it.
+API_TIMEZONE = "Europe/Stockholm"
+
 
 class HTTPRequest(BaseHTTPRequestHandler):
     def __init__(self, request_text):
@@ -33,24 +44,157 @@ class HTTPRequest(BaseHTTPRequestHandler):
         self.error_message = message
 
 
+def get_endpoint_label(url: str) -> str:
+    """The path of the url without ids, e.g. device-info/v1/devices/{id}/status"""
+    parts = urlparse(url).path.strip("/").split("/")
+    if parts and parts[0] == "api":
+        parts = parts[1:]
+    for index in range(1, len(parts)):
+        if parts[index - 1] in ("devices", "users"):
+            parts[index] = "{id}"
+    return "/".join(parts)
+
+
+class AuthenticationError(Exception):
+    """The account could not be logged in."""
+
+
+def create_session(pool_size: int) -> requests.Session:
+    """
+    Shared session for all api calls. Connections to the api are pooled and kept alive,
+    so only the first request to the server pays for the TCP and TLS handshake.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size,
+                          pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def cast_setting_value(value: Any) -> Any:
+    # Try cast to int. If int value is sent as string, the API will return 200 (OK)
+    # but the request will have no effect. The server should either check payload validity
+    # and return 400 with a proper description or try to cast itself.
+    if isinstance(value, str) and value.lstrip('-').isdigit():
+        return int(value)
+    return value
+
+
 class QvantumApi:
-    def __init__(self, config: QvantumApiConfig):
+    def __init__(self, config: QvantumApiConfig, session: Optional[requests.Session] = None,
+                 rate_limiter: Optional[TokenBucket] = None):
         self.config = config
         self.tokens = None
         self.token_user = None
+        # Several accounts can share one session, and with it the connection pool
+        self.session = session if session is not None else create_session(config.http_pool_size)
+        # Rarely changing responses are kept, and revalidated when possible
+        self.cache = ResponseCache(config.get_cache_ttls())
+        # And the request budget
+        self.rate_limiter = rate_limiter if rate_limiter is not None else \
+            TokenBucket(config.rate_limit, config.rate_limit_burst)
+        # Time spent on http requests, per thread
+        self.timing = threading.local()
+        self.token_manager = TokenManager(self.refresh_access_token,
+                                          lambda: self.tokens.expires_in if self.tokens else None,
+                                          self.config.token_refresh_margin)
+
+    def request(self, method: str, url: str, priority: Priority = Priority.POLL, **kwargs) -> requests.Response:
+        """
+        Send a request within the request budget. If the api throttles us (429, or 503 with
+        Retry-After), all requests are paused as long as asked and the request is retried.
+        """
+        # Never wait forever on a hung socket. It would freeze the poll loop.
+        kwargs.setdefault("timeout", (self.config.connect_timeout,
+                                      self.config.read_timeout))
+        endpoint = get_endpoint_label(url)
+        for attempt in range(self.config.rate_limit_retries + 1):
+            wait = self.rate_limiter.acquire(priority)
+            RATE_LIMIT_WAIT.observe(wait, priority=priority.name.lower())
+            start = time.monotonic()
+            try:
+                res = self.session.request(method, url, **kwargs)
+            except requests.RequestException:
+                API_RESPONSES.inc(endpoint=endpoint, code="error")
+                raise
+            finally:
+                duration = time.monotonic() - start
+                API_REQUEST_DURATION.observe(duration, endpoint=endpoint)
+                # Waiting for the budget is waiting for the api as well
+                self.timing.http = getattr(self.timing, "http", 0) + wait + duration
+            API_RESPONSES.inc(endpoint=endpoint, code=res.status_code)
+            retry_after = parse_retry_after(res.headers.get("Retry-After"))
+            if res.status_code != 429 and (res.status_code != 503 or retry_after is None):
+                return res
+            if retry_after is None:
+                retry_after = self.config.retry_after_default
+            log.warning(f"Throttled by the api on {endpoint} ({res.status_code}). "
+                        f"Pausing all requests for {retry_after:.0f}s.")
+            self.rate_limiter.pause(retry_after)
+        return res
+
+    def pop_http_time(self) -> float:
+        """Time spent on http requests by this thread, since the last call."""
+        http_time = getattr(self.timing, "http", 0)
+        self.timing.http = 0
+        return http_time
+
+    def authorized_request(self, method: str, url: str, headers: dict, priority: Priority = Priority.POLL,
+                           **kwargs) -> requests.Response:
+        """
+        Send a request with the access token. If the token is rejected, it is refreshed
+        once and the request is retried.
+        """
+        generation = self.token_manager.generation
+        headers["Authorization"] = f"Bearer {self.tokens.access_token}"
+        res = self.request(method, url, priority, headers=headers, **kwargs)
+        if res.status_code == 401:
+            log.info("Access token rejected. Refreshing token and retrying.")
+            if self.token_manager.refresh(generation):
+                headers["Authorization"] = f"Bearer {self.tokens.access_token}"
+                res = self.request(method, url, priority, headers=headers, **kwargs)
+        return res
+
+    def get_request(self, endpoint: str, priority: Priority = Priority.POLL) -> Any:
+        raw = self.get_raw_request(endpoint, priority)
+        if raw is None:
+            return None
+        return json.loads(raw)
 
-    def get_request(self, endpoint: str) -> Any:
+    def get_raw_request(self, endpoint: str, priority: Priority = Priority.POLL) -> Optional[bytes]:
+        """
+        Get the response body as is. Lets the caller validate the models straight from the
+        bytes, and publish the body without serializing it again.
+        """
         url = f"{self.config.api_endpoint}/{endpoint}"
+        label = get_endpoint_label(url)
+        ttl = self.cache.get_ttl(label)
+        if ttl is not None:
+            return self.cache.get(url, label, ttl,
+                                  lambda validators: self.get_response(url, endpoint, priority, validators))
+        res = self.get_response(url, endpoint, priority)
+        return res.content if res is not None else None
+
+    def get_response(self, url: str, endpoint: str, priority: Priority,
+                     validators: Optional[dict[str, str]] = None) -> Optional[requests.Response]:
+        """The response if 200, or 304 to a conditional request. None if the request failed."""
         headers = {
             'Content-Type': 'application/json',
-            "Authorization": f"Bearer {self.tokens.access_token}"
+            **(validators or {}),
         }
-        res = requests.get(url=url, headers=headers)
+        try:
+            res = self.authorized_request("GET", url, headers, priority)
+        except requests.RequestException as e:
+            log.warning(f"Request failed: {endpoint} {e!r}")
+            return None
+        if res.status_code == 304 and validators:
+            return res
         if res.status_code != 200:
             log.warning(
                 f"Potential server error: {res.status_code} {res.text}")
             return None
-        return json.loads(res.text)
+        return res
 
     def request_access_token(self, code):
         log.info(
@@ -61,23 +205,24 @@ class QvantumApi:
         # api spec not clear about this...
         body = f"client_id={self.config.client_id}&grant_type=authorization_code&code={code}"
         url = f"{self.config.api_endpoint}/api/auth/v1/oauth2/token"
-        res = requests.post(url=url, data=body, headers=headers)
+        res = self.request("POST", url, Priority.AUTH, data=body, headers=headers)
         if res.status_code != 200:
-            log.warning("Could not be authenticated!")
-            sys.exit()
+            raise AuthenticationError(
+                f"Could not be authenticated! {res.status_code} {res.text}")
 
         res_dict = json.loads(res.text)
         self.tokens = Token(**res_dict)
         # update the file in case we need to restart
-        f = open(self.config.auth_file_path, "w")
-        f.write(self.tokens.model_dump_json())
-        f.close()
+        self.save_tokens()
+
+    def save_tokens(self):
+        write_file_atomic(self.config.auth_file_path, self.tokens.model_dump_json())
 
     def load_user_id(self):
         path = "api/auth/v1/whoami"
         res = self.get_request(path)
         if res is None:
-            sys.exit()
+            raise AuthenticationError("Could not get the user of the token")
         self.token_user = TokenUser(**res)
 
     def refresh_access_token(self) -> bool:
@@ -86,17 +231,20 @@ class QvantumApi:
         }
         body = f"client_id={self.config.client_id}&grant_type=refresh_token&refresh_token={self.tokens.refresh_token}"
         url = f"{self.config.api_endpoint}/api/auth/v1/oauth2/token"
-        res = requests.post(url=url, data=body, headers=headers)
+        res = self.request("POST", url, Priority.AUTH, data=body, headers=headers)
         if res.status_code != 200:
             log.info("Refresh token is invalid. Will request a new.")
             # Get a new access code
             return False
         res_dict = json.loads(res.text)
+        old_refresh_token = self.tokens.refresh_token
         self.tokens = Token(**res_dict)
-        # update the file in case we need to restart
-        f = open(self.config.auth_file_path, "w")
-        f.write(self.tokens.model_dump_json())
-        f.close()
+        if self.tokens.refresh_token is None:
+            # Keep using the old refresh token if no new was issued
+            self.tokens.refresh_token = old_refresh_token
+        # update the file in case we need to restart. Only the refresh token is needed for that.
+        if self.tokens.refresh_token != old_refresh_token:
+            self.save_tokens()
         return True
 
     def get_pumps(self) -> DevicesResponse:
@@ -108,49 +256,57 @@ class QvantumApi:
 
     def get_pump_settings(self, device_id: str) -> PumpSettingsResponse:
         path = f"api/device-info/v1/devices/{device_id}/settings"
-        res_dict = self.get_request(path)
-        if res_dict is None:
+        raw = self.get_raw_request(path)
+        if raw is None:
             return None
-        return PumpSettingsResponse(**res_dict)
-
-    def get_pump_status(self, device_id: str) -> tuple[PumpStatusResponse, Any]:
-        path = f"api/device-info/v1/devices/{device_id}/status?metrics=now"
-        res_dict = self.get_request(path)
-        # log.warning(res_dict)
-        if res_dict is None:
-            return None, res_dict
-        return PumpStatusResponse(**res_dict), res_dict
-
-    def get_pump_metrics_inventory(self, device_id: str) -> tuple[MetricsInventoryResponse, Any]:
+        return PumpSettingsResponse.model_validate_json(raw)
+
+    def get_pump_status(self, device_id: str, metrics: Optional[str] = "now") -> tuple[PumpStatusResponse, bytes]:
+        # metrics can be "now", "last" or None to skip the metrics
+        path = f"api/device-info/v1/devices/{device_id}/status"
+        if metrics is not None:
+            path = f"{path}?metrics={metrics}"
+        raw = self.get_raw_request(path)
+        if raw is None:
+            return None, raw
+        return PumpStatusResponse.model_validate_json(raw), raw
+
+    def get_pump_metrics_inventory(self, device_id: str) -> tuple[MetricsInventoryResponse, bytes]:
         path = f"api/inventory/v1/devices/{device_id}/metrics"
-        res_dict = self.get_request(path)
-        if res_dict is None:
-            return None, res_dict
-        return MetricsInventoryResponse(**res_dict), res_dict
+        raw = self.get_raw_request(path)
+        if raw is None:
+            return None, raw
+        return MetricsInventoryResponse.model_validate_json(raw), raw
 
-    def get_pump_metric(self, device_id: str, metrics: list[str]) -> MetricsResponse:
+    def get_pump_metric(self, device_id: str, metrics: list[str], start: Optional[datetime] = None,
+                        end: Optional[datetime] = None, resolution: str = "hourly") -> MetricsResponse:
         metrics_str = ','.join(metrics)
-        path = f"api/metrics/v1/devices/{device_id}/timelines?metric_names={metrics_str}&tz=Europe%2FStockholm&resolution=hourly"
-        res_dict = self.get_request(path)
+        path = f"api/metrics/v1/devices/{device_id}/timelines?metric_names={metrics_str}&tz={quote(API_TIMEZONE, safe='')}&resolution={resolution}"
+        # The range defaults to one week back. Timezone in start/end takes precedence over tz.
+        if start is not None:
+            path += f"&start={quote(start.isoformat())}"
+        if end is not None:
+            path += f"&end={quote(end.isoformat())}"
+        res_dict = self.get_request(path, Priority.BACKFILL)
         if res_dict is None:
             return None
         return MetricsResponse(**res_dict)
 
-    def get_pump_settings_inventory(self, device_id: str) -> tuple[SettingsInventoryResponse, Any]:
+    def get_pump_settings_inventory(self, device_id: str) -> tuple[SettingsInventoryResponse, bytes]:
         path = f"api/inventory/v1/devices/{device_id}/settings"
-        res_dict = self.get_request(path)
-        if res_dict is None:
-            return None, res_dict
-        return SettingsInventoryResponse(**res_dict), res_dict
+        raw = self.get_raw_request(path)
+        if raw is None:
+            return None, raw
+        return SettingsInventoryResponse.model_validate_json(raw), raw
 
     # api does not care about category?
-    def get_pump_alarm_inventory(self, device_id: str) -> AlarmInventoryResponse:
+    def get_pump_alarm_inventory(self, device_id: str) -> tuple[AlarmInventoryResponse, bytes]:
         # ?&category={category.value}" <- No usage
         path = f"api/inventory/v1/devices/{device_id}/alarms"
-        res_dict = self.get_request(path)
-        if res_dict is None:
-            return None
-        return AlarmInventoryResponse(**res_dict)
+        raw = self.get_raw_request(path)
+        if raw is None:
+            return None, raw
+        return AlarmInventoryResponse.model_validate_json(raw), raw
 
     def get_pump_alarm_events(self, device_id: str) -> AlarmEventsResponse:
         # defualt limit is 10
@@ -166,22 +322,29 @@ class QvantumApi:
         """
         Send a patch request and update a setting on the machine.
         """
+        return self.set_pump_settings(device_id, {setting: value})
+
+    def set_pump_settings(self, device_id: str, settings: dict[str, Any]) -> QvantumBaseModel:
+        """
+        Send a patch request and update several settings on the machine at once.
+        """
         headers = {
             'accept': 'application/json',
             'Content-Type': 'application/json',
-            "Authorization": f"Bearer {self.tokens.access_token}"
         }
-        # Try cast to int. If int value is sent as string, the API will return 200 (OK)
-        # but the request will have no effect. The server should either check payload validity
-        # and return 400 with a proper description or try to cast itself.
-        value = int(value) if value.lstrip('-').isdigit() else value
+        set_settings = [SetSetting(name=setting, value=cast_setting_value(value))
+                        for setting, value in settings.items()]
 
-        payload = SetSettingsRequest(
-            settings=[SetSetting(name=setting, value=value)])
+        payload = SetSettingsRequest(settings=set_settings)
 
         url = f"{self.config.api_endpoint}/api/device-info/v1/devices/{device_id}/settings?dispatch=false"
-        res = requests.patch(
-            url=url, data=payload.model_dump_json(), headers=headers)
+        try:
+            res = self.authorized_request(
+                "PATCH", url, headers, Priority.COMMAND, data=payload.model_dump_json())
+        except requests.RequestException as e:
+            log.warning(
+                f"Failed to set {', '.join(settings)} on {device_id}: {e!r}")
+            return None
         if res.status_code != 200:
             log.warning(
                 f"Potential server error: {res.status_code} {res.text}")
@@ -213,11 +376,11 @@ class QvantumApi:
                 serversocket.bind(('', self.config.port))
                 serversocket.listen(1)
 
-            except socket.error as msg:
+            except socket.error as e:
                 # Port might be taken...
-                log.error('Bind failed. Error Code : ' +
-                          str(msg[0]) + ' Message ' + msg[1])
-                sys.exit()
+                serversocket.close()
+                raise AuthenticationError(
+                    f"Bind failed on port {self.config.port}: {e!r}")
 
             # Open a browser to authorize the app
             url = f"{self.config.auth_server}/authorize?response_type=code&client_id={self.config.client_id}&state={self.config.state}&redirect_uri={self.config.redirect}:{self.config.port}"
@@ -237,10 +400,11 @@ class QvantumApi:
             request = HTTPRequest(incoming_data)
             parsed_url = urlparse(request.path)
             qs = parse_qs(parsed_url.query)
-            if qs["code"]:
+            if qs.get("code"):
                 self.request_access_token(qs["code"][0])
             else:
-                log.error("No code returned. Exiting.")
-                sys.exit()
+                raise AuthenticationError("No code returned")
 
         self.load_user_id()
+        # Keep the access token fresh from now on
+        self.token_manager.start()
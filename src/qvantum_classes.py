@@ -4,6 +4,7 @@ from enum import Enum
 import json
 from typing import Any, Optional
 from pydantic import BaseModel, Field
+from pydantic_core import to_json
 
 
 class QvantumBaseModel(BaseModel):
@@ -18,6 +19,14 @@ class QvantumBaseModel(BaseModel):
                 field_names.append(k)
         return field_names
 
+    def dump_json_fast(self) -> bytes:
+        """
+        Same json as model_dump_json, for models that only hold plain json values, such as
+        the status and settings from the api. Skips the per field serializers, which are
+        slow for the union typed metrics and setting values.
+        """
+        return to_json(self.__dict__)
+
     @classmethod
     def get_attributes_template(cls) -> str:
         res = dict()
@@ -78,6 +87,12 @@ class Setting(QvantumBaseModel):
         return "value"
 
 
+class SettingsDocument(QvantumBaseModel):
+    """All settings of a pump in one message, keyed on setting name."""
+    meta: Optional[Meta] = None
+    settings: dict[str, Setting] = {}
+
+
 class DevicesResponse(QvantumBaseModel):
     user_id: Optional[str] = None
     devices: Optional[list[Pump]] = None
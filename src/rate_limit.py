@@ -0,0 +1,96 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from enum import IntEnum
+from typing import Optional
+
+log = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    # Lower goes first
+    AUTH = 0
+    COMMAND = 1
+    POLL = 2
+    BACKFILL = 3
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header, given either as seconds or as an http date."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        until = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if until.tzinfo is None:
+        until = until.replace(tzinfo=timezone.utc)
+    return max((until - datetime.now(timezone.utc)).total_seconds(), 0)
+
+
+class TokenBucket:
+    """
+    Rate limit shared by all calls to the api, of all accounts.
+
+    Allows rate requests per second on average, with bursts of up to burst requests.
+    Calls that have to wait are served by priority, then in order of arrival, so a
+    command never queues behind a backlog of polls. When the api asks to back off
+    (Retry-After), the bucket is paused and no request is sent until the pause is over.
+    A rate of 0 disables the limit, but pauses are still honoured.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.condition = threading.Condition()
+        # (priority, arrival) of the waiting calls
+        self.waiting: list[tuple[int, int]] = []
+        self.arrivals = itertools.count()
+
+    def refill(self, now: float):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority: Priority = Priority.POLL) -> float:
+        """Block until the call may be sent. Returns the time waited."""
+        start = time.monotonic()
+        entry = (int(priority), next(self.arrivals))
+        with self.condition:
+            heapq.heappush(self.waiting, entry)
+            while True:
+                now = time.monotonic()
+                if self.waiting[0] != entry:
+                    # Someone before us. Woken up when they are done.
+                    self.condition.wait()
+                    continue
+                self.refill(now)
+                wait = self.paused_until - now
+                if wait <= 0 and self.rate > 0 and self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                heapq.heappop(self.waiting)
+                if self.rate > 0:
+                    self.tokens -= 1
+                self.condition.notify_all()
+                return now - start
+
+    def pause(self, seconds: float):
+        """Hold back all calls for the given time, e.g. after a 429 with Retry-After."""
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.condition.notify_all()
@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Optional
+
+import requests
+
+from exporter import API_CACHE_REQUESTS
+
+log = logging.getLogger(__name__)
+
+
+class CacheEntry:
+    def __init__(self, body: bytes, etag: Optional[str], last_modified: Optional[str]):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = time.monotonic()
+
+    def get_validators(self) -> dict[str, str]:
+        headers = {}
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    """
+    In-memory cache of api responses, for endpoints that are fetched often but rarely change.
+
+    A response is served from the cache for the ttl of its endpoint. After that, it is
+    revalidated with a conditional request (If-None-Match/If-Modified-Since) if the server
+    sent an ETag or Last-Modified, and the cached body is used again if the answer is 304.
+    A ttl of 0 always revalidates. Concurrent requests for the same url share one call.
+    Endpoints without a ttl are not cached.
+    """
+
+    def __init__(self, ttls: dict[str, float]):
+        # {endpoint label: ttl}
+        self.ttls = ttls
+        self.lock = threading.Lock()
+        # {url: entry}
+        self.entries: dict[str, CacheEntry] = {}
+        # {url: body of the call in flight}
+        self.in_flight: dict[str, Future] = {}
+
+    def get_ttl(self, endpoint: str) -> Optional[float]:
+        return self.ttls.get(endpoint)
+
+    def get(self, url: str, endpoint: str, ttl: float,
+            fetch: Callable[[dict[str, str]], Optional[requests.Response]]) -> Optional[bytes]:
+        """
+        Get the body of the url, from the cache or with fetch. fetch gets the conditional
+        headers, and returns the response if 200 or 304, else None.
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None and time.monotonic() - entry.fetched < ttl:
+                API_CACHE_REQUESTS.inc(endpoint=endpoint, result="hit")
+                return entry.body
+            future = self.in_flight.get(url)
+            leader = future is None
+            if leader:
+                future = self.in_flight[url] = Future()
+        if not leader:
+            API_CACHE_REQUESTS.inc(endpoint=endpoint, result="coalesced")
+            return future.result()
+
+        body = None
+        try:
+            body = self.fetch(url, endpoint, ttl, entry, fetch)
+        finally:
+            with self.lock:
+                del self.in_flight[url]
+            future.set_result(body)
+        return body
+
+    def fetch(self, url: str, endpoint: str, ttl: float, entry: Optional[CacheEntry],
+              fetch: Callable[[dict[str, str]], Optional[requests.Response]]) -> Optional[bytes]:
+        res = fetch(entry.get_validators() if entry is not None else {})
+        if res is None:
+            return None
+        if res.status_code == 304 and entry is not None:
+            API_CACHE_REQUESTS.inc(endpoint=endpoint, result="revalidated")
+            entry.fetched = time.monotonic()
+            return entry.body
+        API_CACHE_REQUESTS.inc(endpoint=endpoint, result="miss")
+        new_entry = CacheEntry(res.content, res.headers.get("ETag"),
+                               res.headers.get("Last-Modified"))
+        # Without a ttl the body is only of use if it can be revalidated
+        if ttl > 0 or new_entry.get_validators():
+            with self.lock:
+                self.entries[url] = new_entry
+        return res.content
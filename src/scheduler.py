@@ -0,0 +1,131 @@
+import logging
+import random
+import threading
+import time
+from enum import Enum
+from typing import Callable, Optional
+
+log = logging.getLogger(__name__)
+
+
+class Endpoint(str, Enum):
+    STATUS = "status"
+    SETTINGS = "settings"
+    ALARMS = "alarms"
+    METADATA = "metadata"
+
+
+class PollScheduler:
+    """
+    Keeps a polling deadline for every pump and endpoint.
+
+    Deadlines are fixed-rate: the next deadline is the previous deadline plus the interval,
+    so the period doesn't drift with the time it takes to poll. If polling falls behind,
+    missed deadlines are skipped instead of polled in a burst. The first deadline of each
+    pump is spread out by a random jitter, so all pumps are not polled at the same time.
+    Pumps that report they are disconnected are polled less often.
+    """
+
+    def __init__(self, intervals: dict[Endpoint, float], offline_factor: float = 1, jitter: float = 0):
+        self.intervals = intervals
+        self.offline_factor = max(1, offline_factor)
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # Called on every wakeup, for poll loops that don't wait on the event
+        self.listeners: list[Callable[[], None]] = []
+        self.deadlines: dict[tuple[str, Endpoint], float] = {}
+        self.offline: set[str] = set()
+
+    def get_interval(self, pump_id: str, endpoint: Endpoint) -> float:
+        interval = self.intervals[endpoint]
+        if pump_id in self.offline:
+            interval *= self.offline_factor
+        return interval
+
+    def add_pump(self, pump_id: str):
+        now = time.monotonic()
+        with self.lock:
+            for endpoint, interval in self.intervals.items():
+                if interval <= 0:
+                    # Polling disabled for this endpoint
+                    continue
+                offset = random.uniform(0, min(self.jitter, interval))
+                self.deadlines[(pump_id, endpoint)] = now + offset
+        self.wake()
+
+    def remove_pump(self, pump_id: str):
+        with self.lock:
+            for key in [key for key in self.deadlines if key[0] == pump_id]:
+                del self.deadlines[key]
+            self.offline.discard(pump_id)
+
+    def get_pumps(self) -> set[str]:
+        with self.lock:
+            return {pump_id for pump_id, _ in self.deadlines}
+
+    def get_due(self) -> list[tuple[str, Endpoint]]:
+        """Get the endpoints due for polling, and move their deadlines forward."""
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            for key, deadline in self.deadlines.items():
+                if deadline > now:
+                    continue
+                due.append(key)
+                next_deadline = deadline + self.get_interval(*key)
+                if next_deadline <= now:
+                    # We are behind. Skip the missed deadlines.
+                    next_deadline = now + self.get_interval(*key)
+                self.deadlines[key] = next_deadline
+        return due
+
+    def get_next_deadline(self) -> Optional[float]:
+        with self.lock:
+            return min(self.deadlines.values(), default=None)
+
+    def get_timeout(self, max_wait: float = 60) -> float:
+        """Time until the next deadline."""
+        next_deadline = self.get_next_deadline()
+        if next_deadline is None:
+            return max_wait
+        return min(max(next_deadline - time.monotonic(), 0), max_wait)
+
+    def wait(self, max_wait: float = 60):
+        """Block until the next deadline, or until woken up by trigger or add_pump."""
+        self.wakeup.wait(self.get_timeout(max_wait))
+        self.wakeup.clear()
+
+    def add_listener(self, listener: Callable[[], None]):
+        self.listeners.append(listener)
+
+    def wake(self):
+        self.wakeup.set()
+        for listener in self.listeners:
+            listener()
+
+    def trigger(self, pump_id: str, endpoint: Endpoint, delay: float = 0):
+        """Poll the endpoint of the pump within delay seconds, out of the normal schedule."""
+        key = (pump_id, endpoint)
+        with self.lock:
+            if key not in self.deadlines:
+                return
+            self.deadlines[key] = min(
+                self.deadlines[key], time.monotonic() + delay)
+        self.wake()
+
+    def set_connected(self, pump_id: str, connected: Optional[bool]):
+        """Slow down polling of pumps that are disconnected. Speed up when they are back."""
+        with self.lock:
+            if connected is False and pump_id not in self.offline:
+                log.info(f"Pump {pump_id} is disconnected. Polling less often.")
+                self.offline.add(pump_id)
+            elif connected and pump_id in self.offline:
+                log.info(f"Pump {pump_id} is connected again.")
+                self.offline.discard(pump_id)
+                # Don't wait out the long offline interval
+                now = time.monotonic()
+                for key, deadline in self.deadlines.items():
+                    if key[0] == pump_id:
+                        self.deadlines[key] = min(
+                            deadline, now + self.get_interval(*key))
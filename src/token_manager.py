@@ -0,0 +1,78 @@
+import logging
+import threading
+from typing import Callable, Optional
+
+from exporter import TOKEN_REFRESHES
+
+log = logging.getLogger(__name__)
+
+
+class TokenManager:
+    """
+    Refreshes the access token in the background, a safety margin before it expires.
+
+    Refreshes are serialized. Every successful refresh bumps the generation, which lets
+    callers that got a 401 with an old token skip the refresh if someone else already
+    did it while they were waiting.
+    """
+
+    # Used if the token response doesn't say when the token expires
+    fallback_interval = 300
+    # Never refresh more often than this, even if the token is very short lived
+    min_interval = 10
+    # Wait time before trying again after a failed refresh
+    retry_interval = 30
+
+    def __init__(self, refresh: Callable[[], bool], get_expires_in: Callable[[], Optional[int]], margin: int):
+        self.refresh_func = refresh
+        self.get_expires_in = get_expires_in
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.timer: Optional[threading.Timer] = None
+        self.generation = 0
+
+    def get_delay(self) -> float:
+        expires_in = self.get_expires_in()
+        if expires_in is None:
+            return self.fallback_interval
+        return max(expires_in - self.margin, self.min_interval)
+
+    def schedule(self, delay: float):
+        if self.timer is not None:
+            self.timer.cancel()
+        log.debug(f"Next token refresh in {delay:.0f} seconds")
+        self.timer = threading.Timer(delay, self.refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def start(self):
+        self.schedule(self.get_delay())
+
+    def stop(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def refresh(self, generation: Optional[int] = None) -> bool:
+        """
+        Refresh the access token. If generation is given, and the token has been refreshed
+        since that generation, nothing is done.
+        """
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return True
+
+            log.info("Refresh token")
+            try:
+                refreshed = self.refresh_func()
+            except Exception as e:
+                log.warning(f"Token refresh failed: {e!r}")
+                refreshed = False
+
+            TOKEN_REFRESHES.inc(result="success" if refreshed else "failure")
+            if refreshed:
+                self.generation += 1
+                self.schedule(self.get_delay())
+            else:
+                log.error("Could not refresh the access token. Will try again.")
+                self.schedule(self.retry_interval)
+            return refreshed
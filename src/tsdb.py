@@ -0,0 +1,228 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Optional
+
+from config import TsdbConfig
+from qvantum_classes import Metrics, MetricsResponse
+
+log = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    pump_id TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    value REAL NOT NULL,
+    PRIMARY KEY (pump_id, metric, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hourly (
+    pump_id TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    min REAL, max REAL, avg REAL, count INTEGER,
+    PRIMARY KEY (pump_id, metric, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily (
+    pump_id TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    min REAL, max REAL, avg REAL, count INTEGER,
+    PRIMARY KEY (pump_id, metric, ts)
+) WITHOUT ROWID;
+-- The rollups and retention select on ts only
+CREATE INDEX IF NOT EXISTS samples_ts ON samples (ts);
+CREATE INDEX IF NOT EXISTS hourly_ts ON hourly (ts);
+"""
+
+
+def parse_timestamp(value: Any) -> Optional[int]:
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        try:
+            # fromisoformat only takes a Z suffix from Python 3.11
+            value = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def get_request_time(value: Any) -> Optional[int]:
+    """A start or end of a history request, in unix time or as an iso timestamp."""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    return parse_timestamp(value)
+
+
+def get_request_pump_id(payload: bytes) -> Optional[str]:
+    """The pump of a history request, None if the request is invalid."""
+    try:
+        pump_id = json.loads(payload).get("pump_id")
+    except (ValueError, AttributeError):
+        return None
+    return pump_id if isinstance(pump_id, str) else None
+
+
+class MetricsStore:
+    """
+    Local time-series store for the polled metrics, in sqlite.
+
+    Samples are buffered in memory and written in batches by the store's own thread, so
+    polling never waits on sqlite. When a batch is written, the hourly and daily rollups
+    (min, max, avg and count) of the touched buckets are recalculated, and data older
+    than the retention of each resolution is removed.
+    Recent history can be queried over mqtt, see handle_request.
+    """
+
+    # Table per resolution
+    tables = {"raw": "samples", "hourly": "hourly", "daily": "daily"}
+
+    def __init__(self, config: TsdbConfig):
+        self.config = config
+        self.db = sqlite3.connect(config.path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.db_lock = threading.Lock()
+        self.buffer: list[tuple[str, str, int, float]] = []
+        self.buffer_lock = threading.Lock()
+        # Set when a batch is full, to flush it before the flush interval
+        self.batch_full = threading.Event()
+        self.last_retention = 0.0
+
+    def add(self, pump_id: str, metrics: Metrics):
+        ts = parse_timestamp(metrics.time)
+        if ts is None:
+            # Empty metrics. The pump has not reported anything recently.
+            return
+        rows = [(pump_id, name, ts, float(value))
+                for name, value in metrics.model_dump(exclude={"time"}).items()
+                if isinstance(value, (int, float)) and not isinstance(value, bool)]
+        with self.buffer_lock:
+            self.buffer.extend(rows)
+            if len(self.buffer) >= self.config.batch_size:
+                self.batch_full.set()
+
+    def add_timeline(self, pump_id: str, resolution: str, timeline: MetricsResponse):
+        """Store aggregated values from the timelines endpoint, e.g. from a backfill."""
+        table = self.tables.get(resolution)
+        if table is None or table == "samples" or not timeline.metrics:
+            return
+        rows = []
+        for point in timeline.metrics:
+            ts = parse_timestamp(point.get("time"))
+            if ts is None:
+                continue
+            for name, value in point.items():
+                if name in ("time", "hpid") or not isinstance(value, (int, float)):
+                    continue
+                rows.append((pump_id, name, ts, value, value, value, 1))
+        with self.db_lock, self.db:
+            # Rollups calculated from our own samples are more detailed. Keep them.
+            self.db.executemany(
+                f"INSERT OR IGNORE INTO {table} VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def flush(self):
+        with self.buffer_lock:
+            rows, self.buffer = self.buffer, []
+        if not rows:
+            return
+        oldest = min(row[2] for row in rows)
+        with self.db_lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)", rows)
+            self.rollup(oldest)
+        log.debug(f"Stored {len(rows)} samples")
+
+    def rollup(self, since: int):
+        """Recalculate the hourly and daily rollups for all buckets from since and on."""
+        hour_start = since - since % HOUR
+        self.db.execute("""
+            INSERT OR REPLACE INTO hourly
+            SELECT pump_id, metric, ts - ts % ?, MIN(value), MAX(value), AVG(value), COUNT(*)
+            FROM samples WHERE ts >= ? GROUP BY pump_id, metric, ts - ts % ?
+        """, (HOUR, hour_start, HOUR))
+        day_start = since - since % DAY
+        self.db.execute("""
+            INSERT OR REPLACE INTO daily
+            SELECT pump_id, metric, ts - ts % ?, MIN(min), MAX(max),
+                SUM(avg * count) / SUM(count), SUM(count)
+            FROM hourly WHERE ts >= ? GROUP BY pump_id, metric, ts - ts % ?
+        """, (DAY, day_start, DAY))
+
+    def apply_retention(self):
+        now = int(time.time())
+        retention = {"samples": self.config.raw_retention_days,
+                     "hourly": self.config.hourly_retention_days,
+                     "daily": self.config.daily_retention_days}
+        with self.db_lock, self.db:
+            for table, days in retention.items():
+                if days > 0:
+                    self.db.execute(
+                        f"DELETE FROM {table} WHERE ts < ?", (now - days * DAY,))
+
+    def query(self, pump_id: str, metric: str, resolution: str = "raw",
+              start: Optional[int] = None, end: Optional[int] = None) -> list[list]:
+        table = self.tables[resolution]
+        columns = "ts, value" if table == "samples" else "ts, min, max, avg, count"
+        start = start if start is not None else 0
+        end = end if end is not None else int(time.time()) + DAY
+        with self.db_lock:
+            rows = self.db.execute(
+                f"SELECT {columns} FROM {table} WHERE pump_id = ? AND metric = ? AND ts >= ? AND ts <= ?"
+                f" ORDER BY ts DESC LIMIT ?",
+                (pump_id, metric, start, end, self.config.max_points)).fetchall()
+        # Latest points are the most interesting if limited, but return them in order
+        return [list(row) for row in reversed(rows)]
+
+    def handle_request(self, payload: bytes) -> tuple[str, str]:
+        """
+        Handle a history request. The request is a json object with pump_id, metric and
+        optionally resolution (raw, hourly or daily), start and end (unix time or iso
+        timestamps), id (echoed in the response) and response_topic.
+        Returns the topic and payload of the response.
+        """
+        response_topic = self.config.response_topic
+        try:
+            request = json.loads(payload)
+            response_topic = request.get("response_topic", response_topic)
+            resolution = request.get("resolution", "raw")
+            if resolution not in self.tables:
+                raise ValueError(f"Unknown resolution {resolution}")
+            start = request.get("start")
+            end = request.get("end")
+            points = self.query(request["pump_id"], request["metric"], resolution,
+                                get_request_time(start), get_request_time(end))
+            response = {"id": request.get("id"),
+                        "pump_id": request["pump_id"],
+                        "metric": request["metric"],
+                        "resolution": resolution,
+                        "points": points}
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            log.warning(f"Invalid history request: {e!r}")
+            response = {"error": repr(e)}
+        return response_topic, json.dumps(response)
+
+    def run(self):
+        while True:
+            self.batch_full.wait(self.config.flush_interval)
+            self.batch_full.clear()
+            try:
+                self.flush()
+                if time.monotonic() - self.last_retention > HOUR:
+                    self.apply_retention()
+                    self.last_retention = time.monotonic()
+            except sqlite3.Error:
+                log.exception("Failed to write metrics to the store")
+
+    def start(self):
+        thread = threading.Thread(
+            target=self.run, name="q2m-tsdb", daemon=True)
+        thread.start()